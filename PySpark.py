@@ -511,6 +511,139 @@ dense_rank_df.filter(col("salary_rank") == 2).show()
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC
+# MAGIC #### Top N rows per group
+
+# COMMAND ----------
+
+# top_n_per_group() is the rank-then-filter of the window functions section with the choices in one place :
+# the filter (rank <= k, or rank == k for only the k-th) on a rank / dense_rank / row_number window
+# on spark 3.5+ the optimizer turns such a filter into a window group limit however the code is split
+# (dense_rank_df.filter(...) above gets it too) : every partition keeps only the first k rows of each group before the shuffle
+# before spark 3.5 there is no such limit for k > 1, every row of every group is shuffled and sorted
+# ties -> "row" (row_number, exactly k rows), "rank" (rank, ties included, ranks skipped) or "dense" (dense_rank, k highest values)
+# the single top row (k=1, ties="row") doesn't need a window at all, max_by() / min_by() keeps one row per group while aggregating
+# nulls in the order column come last both ways (and on both paths), a group with only nulls still gives one row
+
+from pyspark.sql.window import Window
+from pyspark.sql.functions import col, row_number, rank, dense_rank, max_by, min_by, struct
+
+def top_n_per_group(df, group, order, k=1, ties="dense", kth=False, ascending=False, rank_col=None):
+    groups = [group] if isinstance(group, str) else list(group)
+    if k == 1 and ties == "row" and rank_col is None:
+        # max_by() / min_by() skip null keys, the key (has a value, value) is never null and puts the nulls last
+        row = struct(*[c for c in df.columns if c not in groups])
+        pick = min_by(row, struct(col(order).isNull(), col(order))) if ascending else max_by(row, struct(col(order).isNotNull(), col(order)))
+        top = df.groupBy(*groups).agg(pick.alias("_top"))
+        return top.select(*[col(c) if c in groups else col("_top")[c].alias(c) for c in df.columns])
+
+    rank_function = {"row": row_number, "rank": rank, "dense": dense_rank}[ties]
+    win = Window.partitionBy(*groups).orderBy(col(order).asc_nulls_last() if ascending else col(order).desc_nulls_last())
+    name = rank_col or "_rank"
+    ranked = df.withColumn(name, rank_function().over(win))
+    ranked = ranked.filter(col(name) == k if kth else col(name) <= k)
+    return ranked if rank_col else ranked.drop(name)
+
+# COMMAND ----------
+
+# same as dense_rank_df.filter(col("salary_rank") == 2)
+
+top_n_per_group(all_emp_df, "state", "salary", k=2, kth=True, rank_col="salary_rank").show()
+
+# COMMAND ----------
+
+# highest paid employee of every state
+
+top_n_per_group(all_emp_df, "state", "salary", k=1, ties="row").show()
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC
+# MAGIC #### Caching dbutils.fs.ls()
+
+# COMMAND ----------
+
+# every dbutils.fs.ls() is a new listing call to the storage, and listing a big tree on blob storage takes minutes
+# FsIndex lists every directory only once and keeps the paths, sizes and modification times
+# our own writers (save_indexed(), compact(), write_planned(), api_to_table()) invalidate the written path,
+# for writes done in any other way call fs_index.invalidate(path)
+
+import fnmatch
+
+class FsIndex:
+    def __init__(self):
+        self.listings = {}
+        self.callbacks = []
+        self.hits, self.misses = 0, 0
+
+    @staticmethod
+    def _key(path):
+        if path.startswith("dbfs:"):
+            path = path[len("dbfs:"):]
+        return path.rstrip("/") or "/"
+
+    def ls(self, path):
+        key = self._key(path)
+        if key in self.listings:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.listings[key] = dbutils.fs.ls(path)
+        return self.listings[key]
+
+    def walk(self, path, include_hidden=False):
+        for f in self.ls(path):
+            if not include_hidden and f.name.startswith(("_", ".")):
+                continue
+            if f.isDir():
+                yield from self.walk(f.path, include_hidden)
+            else:
+                yield f
+
+    def glob(self, pattern):
+        key = self._key(pattern)
+        parts = key.strip("/").split("/")
+        first = next((i for i, p in enumerate(parts) if any(c in p for c in "*?[")), len(parts))
+        if first == len(parts):
+            return [f for f in self.ls(key.rsplit("/", 1)[0] or "/") if self._key(f.path) == key]
+        matches = [f for f in self.ls("/" + "/".join(parts[:first])) if fnmatch.fnmatch(f.name.rstrip("/"), parts[first])]
+        for part in parts[first+1:]:
+            matches = [f for m in matches if m.isDir() for f in self.ls(m.path) if fnmatch.fnmatch(f.name.rstrip("/"), part)]
+        return matches
+
+    def summary(self, pattern, include_hidden=False):
+        files = []
+        for f in self.glob(pattern):
+            files.extend(self.walk(f.path, include_hidden) if f.isDir() else [f])
+        return {"files": len(files), "bytes": sum(f.size for f in files)}
+
+    def invalidate(self, path):
+        key = self._key(path)
+        for k in list(self.listings):
+            if k == key or k.startswith(key.rstrip("/") + "/"):
+                del self.listings[k]
+        # a write can create several new directories, every listing above the path can be missing them
+        parent = key
+        while parent != "/":
+            parent = parent.rsplit("/", 1)[0] or "/"
+            self.listings.pop(parent, None)
+        for callback in self.callbacks:
+            callback(key)
+
+fs_index = FsIndex()
+
+def save_indexed(writer, path):
+    writer.save(path)
+    fs_index.invalidate(path)
+
+# COMMAND ----------
+
+fs_index.ls("/FileStore/tables/airlines")
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC
 # MAGIC #### Using repartition()
@@ -679,6 +812,372 @@ spark.read.option("header", "true").csv("/FileStore/tables/emp_data/department=F
 
 # COMMAND ----------
 
+# files and bytes of every department / state directory with one listing per directory (fs_index is from the caching dbutils.fs.ls() section)
+# emp_data was written with csv() and not save_indexed(), so the old listings are dropped first
+
+fs_index.invalidate("/FileStore/tables/emp_data")
+fs_index.summary("/FileStore/tables/emp_data/department=*/state=*")
+
+# COMMAND ----------
+
+# second time it comes from the index, no listing call
+
+fs_index.summary("/FileStore/tables/emp_data/department=*/state=*")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC
+# MAGIC #### Compacting small files
+
+# COMMAND ----------
+
+# every overwrite / append on a partitioned output leaves a few small part files in every partition directory,
+# and opening the files takes more time than reading them
+# compact() goes through every partition directory, groups the small files into bins of ~target_bytes (biggest first)
+# and rewrites every bin as one file
+# the new file is written in a hidden _compaction directory (spark ignores names starting with _ while reading),
+# then moved in and the old files removed, so readers see either the old or the new files except for that short moment
+# before the move a _compaction-<id>.json journal with the new and old files is written next to it,
+# if a run fails in the middle the next compact() finishes the swap from the journal (the new file is already complete),
+# and staging directories without a journal (failed before the swap started) are removed
+# delta tables are compacted with OPTIMIZE instead, which does the swap in one commit
+
+import json, uuid
+from delta.tables import DeltaTable
+
+def _data_files(path):
+    return [f for f in dbutils.fs.ls(path) if not f.isDir() and not f.name.startswith(("_", "."))]
+
+def _partition_dirs(path):
+    subdirs = [f.path for f in dbutils.fs.ls(path) if f.isDir() and not f.name.startswith(("_", "."))]
+    return ([path] if _data_files(path) else []) + [d for sub in subdirs for d in _partition_dirs(sub)]
+
+def _bin_pack(files, target_bytes):
+    bins = []
+    for f in sorted(files, key=lambda f: f.size, reverse=True):
+        for b in bins:
+            if b[0] + f.size <= target_bytes:
+                b[0] += f.size
+                b[1].append(f)
+                break
+        else:
+            bins.append([f.size, [f]])
+    return [b[1] for b in bins if len(b[1]) > 1]
+
+def _exists(path):
+    try:
+        dbutils.fs.ls(path)
+        return True
+    except Exception:
+        return False
+
+def _finish_swap(journal):
+    swap = json.loads(dbutils.fs.head(journal, 10*1024*1024))
+    for staged, final in swap["new"]:
+        if _exists(staged):
+            dbutils.fs.mv(staged, final)
+    for old in swap["old"]:
+        if _exists(old):
+            dbutils.fs.rm(old)
+    dbutils.fs.rm(swap["staging"], True)
+    dbutils.fs.rm(journal)
+
+def _recover_compaction(path):
+    entries = dbutils.fs.ls(path)
+    journals = {f.name[:-len(".json")] for f in entries if f.name.startswith("_compaction-") and f.name.endswith(".json")}
+    for name in sorted(journals):
+        print(f"Finishing interrupted compaction {path.rstrip('/')}/{name}")
+        _finish_swap(f"{path.rstrip('/')}/{name}.json")
+    for f in entries:
+        if f.isDir() and f.name.startswith("_compaction-") and f.name.rstrip("/") not in journals:
+            dbutils.fs.rm(f.path, True)
+        elif f.isDir() and not f.name.startswith(("_", ".")):
+            _recover_compaction(f.path)
+
+def compact(path, format="parquet", target_bytes=128*1024*1024, small_file_bytes=None, **options):
+    if format == "delta":
+        table = DeltaTable.forPath(spark, path)
+        before = table.detail().select("numFiles", "sizeInBytes").first()
+        previous = spark.conf.get("spark.databricks.delta.optimize.maxFileSize", None)
+        spark.conf.set("spark.databricks.delta.optimize.maxFileSize", target_bytes)
+        try:
+            table.optimize().executeCompaction()
+        finally:
+            if previous is None:
+                spark.conf.unset("spark.databricks.delta.optimize.maxFileSize")
+            else:
+                spark.conf.set("spark.databricks.delta.optimize.maxFileSize", previous)
+        after = table.detail().select("numFiles", "sizeInBytes").first()
+        fs_index.invalidate(path)
+        report = {"files_before": before.numFiles, "bytes_before": before.sizeInBytes, "files_after": after.numFiles, "bytes_after": after.sizeInBytes}
+        print(report)
+        return report
+
+    small_file_bytes = small_file_bytes or target_bytes // 2
+    _recover_compaction(path)
+    report = {"files_before": 0, "bytes_before": 0, "files_after": 0, "bytes_after": 0}
+    for partition in _partition_dirs(path):
+        partition = partition.rstrip("/")
+        files = _data_files(partition)
+        report["files_before"] += len(files)
+        report["bytes_before"] += sum(f.size for f in files)
+
+        for group in _bin_pack([f for f in files if f.size < small_file_bytes], target_bytes):
+            staging = f"{partition}/_compaction-{uuid.uuid4().hex}"
+            spark.read.format(format).options(**options).load([f.path for f in group]) \
+                .coalesce(1).write.format(format).options(**options).save(staging)
+            swap = {"staging": staging, "new": [(f.path, f"{partition}/{f.name}") for f in _data_files(staging)], "old": [f.path for f in group]}
+            dbutils.fs.put(f"{staging}.json", json.dumps(swap), True)
+            _finish_swap(f"{staging}.json")
+
+        files = _data_files(partition)
+        report["files_after"] += len(files)
+        report["bytes_after"] += sum(f.size for f in files)
+
+    fs_index.invalidate(path)
+    print(report)
+    return report
+
+# COMMAND ----------
+
+compact("/FileStore/tables/emp_data", format="csv", header="true")
+
+# COMMAND ----------
+
+compact("/FileStore/tables/airlines1", format="parquet")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC
+# MAGIC #### Removing duplicates across appends
+
+# COMMAND ----------
+
+# distinct() and dropDuplicates() only see one dataframe, df10.write.mode("append") writes the same rows again on every run
+# KeyIndex keeps the keys of everything appended so far in a small parquet index next to the data
+# (only the key columns as strings + a 64 bit hash, partitioned by bucket = hash % buckets)
+# and a bloom filter of the hashes (_bloom.npz, sized for `capacity` keys, ~30 MB for 10 million keys at fpp=1e-5)
+# a new batch is first deduplicated within itself, then every row is checked against the bloom filter on the executors :
+# rows it rules out are new without reading the index, only the rows it can't rule out (keys appended before, plus
+# ~fpp of the new ones) are anti joined against the buckets they touch, on the hash and then on the key values themselves
+# so a batch of new keys reads almost nothing of the index however long the history is,
+# but a batch which replays many old keys still reads every bucket those keys are in
+# the bloom filter is updated first, a run failing after it only leaves extra bits (those keys are checked exactly)
+# a delta target is written exactly once : the new rows are first staged in _pending-<version> next to the index, then the
+#   bloom filter, the index and the target are written, the target with delta's idempotent writes (txnAppId = index path,
+#   txnVersion = version), and the next append() finishes a failed run from the staged rows
+#   (the index can get the same keys twice, which only takes space, and delta skips the second write of the target)
+# other formats have no transaction : the target is written before the index, so a run failing between the two leaves
+#   rows in the target whose keys are not in the index, and the next run with the same rows appends them again
+# every append adds up to `buckets` small files to the index, run key_index.compact() from time to time,
+# past `capacity` keys the bloom filter rules out less and less, rebuild it with rebuild_bloom(bigger capacity)
+
+import json, math, os, tempfile, time
+import numpy as np
+import pandas as pd
+from pyspark.sql.functions import col, lit, pandas_udf, pmod, xxhash64
+
+# bit positions of a 64 bit hash : (low 32 bits + i * high 32 bits) % size for i in 0..hash_count-1, the bloom filter is kept
+# as 64 bit words, bits are set on the driver from the hashes of the batch (8 bytes a row) and checked on the executors
+
+def _key_bloom_positions(hashes, size, hash_count):
+    h = np.asarray(hashes, dtype=np.int64).view(np.uint64)
+    h1, h2 = h & np.uint64(0xffffffff), h >> np.uint64(32)
+    return ((h1[:, None] + np.arange(hash_count, dtype=np.uint64)[None, :] * h2[:, None]) % np.uint64(size)).astype(np.int64)
+
+class KeyIndex:
+    def __init__(self, path, keys, buckets=64, capacity=10000000, fpp=1e-5):
+        self.path = path.rstrip("/")
+        self.keys = [keys] if isinstance(keys, str) else list(keys)
+        self.buckets = buckets
+        self.fpp = fpp
+        self._size_bloom(capacity)
+        self.last_check = None
+
+    def _size_bloom(self, capacity):
+        self.capacity = capacity
+        self.bloom_size = math.ceil(-capacity * math.log(self.fpp) / math.log(2) ** 2)
+        self.bloom_hashes = max(1, round(self.bloom_size / capacity * math.log(2)))
+        self.bloom = None
+
+    def _hashed(self, df):
+        key_hash = xxhash64(*[col(k).cast("string") for k in self.keys])
+        return df.withColumn("_key_hash", key_hash).withColumn("_bucket", pmod(key_hash, lit(self.buckets)))
+
+    def _exists(self):
+        try:
+            return any(f.name.startswith("bucket=") for f in fs_index.ls(self.path))
+        except Exception:
+            return False
+
+    def _load_bloom(self):
+        if self.bloom is None:
+            fd, local = tempfile.mkstemp(suffix=".npz")
+            os.close(fd)
+            try:
+                dbutils.fs.cp(f"{self.path}/_bloom.npz", f"file:{local}")
+                saved = np.load(local)
+                self.bloom_size, self.bloom_hashes, self.bloom = int(saved["size"]), int(saved["hashes"]), saved["bits"]
+            except Exception:
+                self.bloom = np.zeros((self.bloom_size + 63) // 64, dtype=np.uint64)
+                if self._exists():
+                    # index written without a bloom filter, everything in it goes in first
+                    self._add_to_bloom(spark.read.parquet(self.path).select(col("key_hash").alias("_key_hash")))
+            finally:
+                if os.path.exists(local):
+                    os.remove(local)
+        return self.bloom
+
+    def _add_to_bloom(self, keyed):
+        bits = self._load_bloom().copy()
+        hashes = keyed.select("_key_hash").toPandas()["_key_hash"].to_numpy()
+        for start in range(0, len(hashes), 1000000):
+            pos = _key_bloom_positions(hashes[start:start + 1000000], self.bloom_size, self.bloom_hashes).ravel()
+            np.bitwise_or.at(bits, pos >> 6, np.left_shift(np.uint64(1), (pos & 63).astype(np.uint64)))
+        fd, local = tempfile.mkstemp(suffix=".npz")
+        os.close(fd)
+        try:
+            np.savez(local, bits=bits, size=self.bloom_size, hashes=self.bloom_hashes)
+            dbutils.fs.cp(f"file:{local}", f"{self.path}/_bloom.npz")
+        finally:
+            os.remove(local)
+        self.bloom = bits
+
+    def rebuild_bloom(self, capacity=None):
+        self._size_bloom(capacity or self.capacity)
+        self.bloom = np.zeros((self.bloom_size + 63) // 64, dtype=np.uint64)
+        self._add_to_bloom(spark.read.parquet(self.path).select(col("key_hash").alias("_key_hash")))
+
+    def _might_contain(self, hashes):
+        bits = sc.broadcast(self._load_bloom())
+        size, hash_count = self.bloom_size, self.bloom_hashes
+
+        @pandas_udf("boolean")
+        def might_contain(h: pd.Series) -> pd.Series:
+            pos = _key_bloom_positions(h.to_numpy(), size, hash_count)
+            return pd.Series(((bits.value[pos >> 6] >> (pos & 63).astype(np.uint64)) & np.uint64(1)).all(axis=1))
+
+        return might_contain(hashes)
+
+    def new_rows(self, df):
+        batch = self._hashed(df).dropDuplicates(self.keys)
+        if not self._exists():
+            self.last_check = {"suspects": 0, "buckets_read": 0}
+            return batch
+        batch = batch.withColumn("_maybe_seen", self._might_contain(col("_key_hash")))
+        suspects = batch.where(col("_maybe_seen"))
+        touched = {r["_bucket"]: r["count"] for r in suspects.groupBy("_bucket").count().collect()}
+        self.last_check = {"suspects": sum(touched.values()), "buckets_read": len(touched)}
+        if not touched:
+            return batch.drop("_maybe_seen")
+        seen = spark.read.parquet(self.path).where(col("bucket").isin(list(touched))) \
+            .select(col("key_hash").alias("_seen_hash"), *[col(k).alias(f"_seen_{k}") for k in self.keys])
+        condition = [col("_key_hash") == col("_seen_hash")] + [col(k).cast("string").eqNullSafe(col(f"_seen_{k}")) for k in self.keys]
+        checked = suspects.join(seen, condition, "left_anti")
+        return batch.where(~col("_maybe_seen")).unionByName(checked).drop("_maybe_seen")
+
+    def _add_to_index(self, keyed):
+        keyed = keyed.select(*[col(k).cast("string") for k in self.keys], col("_key_hash").alias("key_hash"), col("_bucket").alias("bucket"))
+        save_indexed(keyed.repartition("bucket").write.mode("append").partitionBy("bucket").format("parquet"), self.path)
+
+    def add(self, df):
+        keyed = self._hashed(df.select(*self.keys).dropDuplicates())
+        self._add_to_bloom(keyed)
+        self._add_to_index(keyed)
+
+    def _commit(self, pending):
+        target = json.loads(dbutils.fs.head(f"{pending}/_target.json", 1024*1024))
+        staged = spark.read.parquet(pending)
+        self._add_to_bloom(staged)
+        self._add_to_index(staged)
+        writer = staged.drop("_key_hash", "_bucket").write.format("delta").mode("append") \
+            .option("txnAppId", self.path).option("txnVersion", target["version"]).options(**target["options"])
+        save_indexed(writer, target["path"])
+        dbutils.fs.rm(pending, True)
+        fs_index.invalidate(pending)
+
+    def _recover(self):
+        try:
+            entries = dbutils.fs.ls(self.path)
+        except Exception:
+            return
+        for f in entries:
+            if f.isDir() and f.name.startswith("_pending-"):
+                pending = f.path.rstrip("/")
+                if _exists(f"{pending}/_target.json"):
+                    print(f"Finishing interrupted append {pending}")
+                    self._commit(pending)
+                else:
+                    # failed while staging, nothing else was written yet
+                    dbutils.fs.rm(pending, True)
+                    fs_index.invalidate(pending)
+
+    def append(self, df, path, format="csv", **options):
+        self._recover()
+        new = self.new_rows(df).persist()
+        rows = new.count()
+        if rows and format == "delta":
+            version = time.time_ns() // 1000
+            pending = f"{self.path}/_pending-{version}"
+            save_indexed(new.write.format("parquet"), pending)
+            dbutils.fs.put(f"{pending}/_target.json", json.dumps({"path": path, "version": version, "options": options}))
+            self._commit(pending)
+        elif rows:
+            self._add_to_bloom(new)
+            save_indexed(new.drop("_key_hash", "_bucket").write.format(format).mode("append").options(**options), path)
+            self._add_to_index(new)
+        new.unpersist()
+        print(f"{rows} new rows appended to {path}, {self.last_check['suspects']} rows checked against {self.last_check['buckets_read']} of {self.buckets} index buckets")
+        return rows
+
+    def compact(self, target_bytes=128*1024*1024):
+        return compact(self.path, format="parquet", target_bytes=target_bytes)
+
+# COMMAND ----------
+
+employee_keys = KeyIndex("dbfs:/user/hive/warehouse/_keys/employees", ["employee_name", "department"])
+
+# rows already in employees.csv (written without the index) are added once, after that the target is not read anymore
+employee_keys.add(spark.read.format("csv").load("dbfs:/user/hive/warehouse/employees.csv").toDF(*df10.columns))
+
+# COMMAND ----------
+
+# second run of the same append writes nothing
+
+employee_keys.append(df10, "dbfs:/user/hive/warehouse/employees.csv")
+employee_keys.append(df10.union(spark.createDataFrame([("Sara","Finance","CA",95000,31,21000)], df10.schema)), "dbfs:/user/hive/warehouse/employees.csv")
+
+# COMMAND ----------
+
+# batches of 1 million new keys : the bloom filter rules out (almost) every row, so the index is (almost) not read
+# and the time of one append doesn't grow with the history
+# the last batch replays 200000 keys of the batch before, those rows are checked against the buckets they are in,
+# which is every bucket here : a replaying batch reads the key index of those buckets (not the target)
+
+import time
+from pyspark.sql.functions import rand
+
+events_keys = KeyIndex("/FileStore/tables/_keys/events", "event_id")
+for i in range(10):
+    start_id = i * 1000000 if i < 9 else 8 * 1000000 + 800000
+    batch = spark.range(start_id, start_id + 1000000).select(col("id").alias("event_id"), (rand(i) * 100).alias("value"))
+    start = time.time()
+    events_keys.append(batch, "/FileStore/tables/events", format="parquet")
+    print(f"batch {i} : {time.time() - start:.2f} sec")
+
+# COMMAND ----------
+
+# a delta target is written exactly once, even when a run fails half way (see above)
+
+employee_keys_delta = KeyIndex("/FileStore/tables/_keys/employees_delta", ["employee_name", "department"])
+employee_keys_delta.append(df10, "/FileStore/tables/employees_delta", format="delta")
+employee_keys_delta.append(df10, "/FileStore/tables/employees_delta", format="delta")
+spark.read.format("delta").load("/FileStore/tables/employees_delta").count() == df10.dropDuplicates(["employee_name", "department"]).count()
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC
 # MAGIC #### Creating UDF (User Defined Functions)
@@ -739,6 +1238,89 @@ spark.udf.register("case_convert_sql", convertcase)
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC
+# MAGIC #### Vectorized UDF (pandas_udf)
+
+# COMMAND ----------
+
+# udf() sends the rows to the python worker one by one (pickled), so for big tables the udf call takes most of the job time
+# pandas_udf() sends whole batches of the column using Arrow and we work on a pandas Series instead of a single value
+# null values stay null here, convertcase(None) throws an error
+
+import pandas as pd
+from pyspark.sql.functions import pandas_udf
+
+@pandas_udf("string")
+def col_convert_vectorized(s: pd.Series) -> pd.Series:
+    return s.str.swapcase()
+
+# COMMAND ----------
+
+emp_df.select("employee_name", col_convert_vectorized(col("employee_name")).alias("Case Converted")).show()
+
+# COMMAND ----------
+
+# use vectorized udf in sql
+
+spark.udf.register("case_convert_sql_vectorized", col_convert_vectorized)
+
+# COMMAND ----------
+
+# MAGIC %sql
+# MAGIC
+# MAGIC select case_convert_sql_vectorized(Active) from airlines;
+
+# COMMAND ----------
+
+# comparing udf vs pandas_udf on ~5 million airline names
+# noop format runs the complete query without writing or collecting anything
+
+import time
+from pyspark.sql.functions import explode, sequence, lit
+
+def benchmark(name, df):
+    start = time.time()
+    df.write.format("noop").mode("overwrite").save()
+    seconds = time.time() - start
+    print(f"{name} : {seconds:.2f} sec")
+    return seconds
+
+airline_names = spark.table("airlines").select("Name").na.drop()
+copies = 5000000 // airline_names.count() + 1
+big_names = airline_names.withColumn("copy", explode(sequence(lit(1), lit(copies)))).select("Name").cache()
+big_names.count()
+
+benchmark("udf", big_names.select(col_convert(col("Name"))))
+benchmark("pandas_udf", big_names.select(col_convert_vectorized(col("Name"))))
+
+# both should give the same result
+print(airline_names.filter(col_convert(col("Name")) != col_convert_vectorized(col("Name"))).count() == 0)
+
+big_names.unpersist()
+
+# COMMAND ----------
+
+# 20 million rows, 50 states, default config : rank-then-filter of the window functions section vs top_n_per_group()
+# (from the top n rows per group section), for k > 1 both get the same window group limit plan on spark 3.5+,
+# for k=1 the max_by() path doesn't sort the groups at all
+
+from pyspark.sql.window import Window
+from pyspark.sql.functions import dense_rank, rand, row_number
+
+big_emp_df = spark.range(20000000).select(col("id").alias("employee_id"), (rand(1) * 50).cast("int").alias("state"), (rand(2) * 100000).cast("int").alias("salary")).cache()
+big_emp_df.count()
+
+salary_desc = Window.partitionBy("state").orderBy(col("salary").desc())
+benchmark("dense_rank then filter, k=3", big_emp_df.withColumn("salary_rank", dense_rank().over(salary_desc)).filter(col("salary_rank") <= 3))
+benchmark("top_n_per_group, k=3", top_n_per_group(big_emp_df, "state", "salary", k=3))
+benchmark("row_number then filter, k=1", big_emp_df.withColumn("row", row_number().over(salary_desc)).filter(col("row") == 1))
+benchmark("top_n_per_group, k=1", top_n_per_group(big_emp_df, "state", "salary", k=1, ties="row"))
+
+big_emp_df.unpersist()
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC
 # MAGIC #### Using cast()
@@ -839,6 +1421,66 @@ df.na.fill(avg_value, ["salary"]).show()
 
 # COMMAND ----------
 
+# every column filled like above costs one more scan (the avg) and one more projection (the fill)
+# NullImputer computes the statistics of all the columns in one agg() (mean, median or mode for each column),
+# keeps them, so the next batches are filled with the same values without computing them again,
+# and fills all the columns in one select()
+# save() / load() keep the statistics in dbfs as json, to reuse them in another job
+
+import json
+from pyspark.sql.functions import avg, coalesce, col, lit, mode, percentile_approx
+
+class NullImputer:
+    aggregates = {"mean": avg, "median": lambda c: percentile_approx(c, 0.5), "mode": mode}
+
+    def __init__(self, strategies, stats=None):
+        unknown = set(strategies.values()) - set(self.aggregates)
+        if unknown:
+            raise ValueError(f"Unknown strategies : {unknown}, use one of {list(self.aggregates)}")
+        self.strategies = strategies
+        self.stats = stats
+
+    def fit(self, df):
+        self.stats = df.agg(*[self.aggregates[s](col(c)).alias(c) for c, s in self.strategies.items()]).first().asDict()
+        return self
+
+    def transform(self, df):
+        if self.stats is None:
+            raise ValueError("Call fit() or load() before transform()")
+        return df.select([
+            coalesce(col(c), lit(self.stats[c]).cast(df.schema[c].dataType)).alias(c) if self.stats.get(c) is not None else col(c)
+            for c in df.columns
+        ])
+
+    def fit_transform(self, df):
+        return self.fit(df).transform(df)
+
+    def save(self, path):
+        dbutils.fs.put(path, json.dumps({"strategies": self.strategies, "stats": self.stats}, default=str), True)
+
+    @classmethod
+    def load(cls, path):
+        saved = json.loads(dbutils.fs.head(path, 10*1024*1024))
+        return cls(saved["strategies"], saved["stats"])
+
+# COMMAND ----------
+
+sampleData = [(1, "Vishal", 100), (2, "Raj", None), (3, None, 300), (4, "Superman", None)]
+df = spark.createDataFrame(data = sampleData, schema = ["id", "name", "salary"])
+
+imputer = NullImputer({"salary": "mean", "name": "mode"})
+imputer.fit_transform(df).show()
+
+# COMMAND ----------
+
+# next batch reuses the statistics of the first one, no aggregation
+
+imputer.save("/FileStore/tables/imputer/emp.json")
+new_batch = spark.createDataFrame([(5, None, None)], "id long, name string, salary long")
+NullImputer.load("/FileStore/tables/imputer/emp.json").transform(new_batch).show()
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC
 # MAGIC #### Pivoting the dataframe
@@ -878,6 +1520,78 @@ display(df_pivot)
 
 # COMMAND ----------
 
+# without the list of values, pivot() first runs a separate job only to find the distinct values of state
+# with pivot("state", ["CA", "NY"]) it is a single aggregation
+# ValueDomains keeps the distinct values of a column per dataset as json in dbfs,
+# it is computed once and then only the new data is added with update() (appends), so the table is never scanned for it again
+# rows with a value missing from the list are left out of the pivot, so update() must be called for every new batch
+# every aggregate makes one column per value, pass the aggregates as aggs and max_columns caps values x aggregates
+# (without aggs the grouped data is returned and the cap is per aggregate)
+
+import json
+from pyspark.sql.functions import sum as sum_
+
+class ValueDomains:
+    def __init__(self, root="/FileStore/tables/value_domains"):
+        self.root = root
+        self.domains = {}
+
+    def _path(self, dataset, column):
+        return f"{self.root}/{dataset}/{column}.json"
+
+    def get(self, dataset, column):
+        if (dataset, column) not in self.domains:
+            try:
+                self.domains[(dataset, column)] = json.loads(dbutils.fs.head(self._path(dataset, column), 10*1024*1024))
+            except Exception:
+                return None
+        return self.domains[(dataset, column)]
+
+    def update(self, dataset, column, df):
+        new_values = [r[0] for r in df.select(column).distinct().collect()]
+        values = sorted(set(self.get(dataset, column) or []) | set(new_values), key=lambda v: (v is None, str(v)))
+        dbutils.fs.put(self._path(dataset, column), json.dumps(values, default=str), True)
+        self.domains[(dataset, column)] = values
+        return values
+
+value_domains = ValueDomains()
+
+def pivot_grouped(df, group_by, pivot_col, values=None, dataset=None, max_columns=100, aggs=None):
+    if values is None and dataset is not None:
+        values = value_domains.get(dataset, pivot_col)
+        if values is None:
+            values = value_domains.update(dataset, pivot_col, df)
+    if values is None:
+        raise ValueError(f"No values for pivot column {pivot_col}, pass values or a dataset name to look them up")
+    columns = len(values) * (len(aggs) if aggs else 1)
+    if columns > max_columns:
+        raise ValueError(f"Pivot on {pivot_col} would create {columns} columns, more than max_columns={max_columns}")
+    group_by = [group_by] if isinstance(group_by, str) else group_by
+    pivoted = df.groupBy(*group_by).pivot(pivot_col, values)
+    return pivoted.agg(*aggs) if aggs else pivoted
+
+# COMMAND ----------
+
+df_pivot = pivot_grouped(emp_df, "department", "state", values=["CA", "NY"]).sum("salary", "bonus")
+display(df_pivot)
+
+# COMMAND ----------
+
+# first call computes and saves the domain, after that it comes from the cache
+
+df_pivot = pivot_grouped(emp_df, "department", "state", dataset="emp", aggs=[sum_("salary"), sum_("bonus")])
+display(df_pivot)
+
+# COMMAND ----------
+
+# a new batch with a new state, only the batch is scanned to update the domain
+
+new_emp = spark.createDataFrame([("Anil", "Sales", "TX", 70000, 30, 9000)], schema)
+value_domains.update("emp", "state", new_emp)
+display(pivot_grouped(emp_df.union(new_emp), "department", "state", dataset="emp", aggs=[sum_("salary"), sum_("bonus")]))
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC
 # MAGIC #### Types of mode while reading
@@ -997,6 +1711,67 @@ df.collect()[0:2]
 
 # COMMAND ----------
 
+# collect() brings the complete dataframe to the driver before the loop starts
+# toLocalIterator() brings one partition at a time and runs the job for the next partition only when the loop reaches it,
+# so breaking out of the loop never computes the remaining partitions
+# the partitions are used as they are (no repartition, which would shuffle everything before the first row and lose the
+# order of an orderBy), if the size estimated by the optimizer is more than max_partition_bytes per partition we stop
+# before reading anything and say how to split it
+# (the optimizer doesn't know the size of every source, for example createDataFrame(), it gives those leaves
+# spark.sql.defaultSizeInBytes (Long.MaxValue) and a select() above scales that down to a huge but not maximal number,
+# so the size is unknown as soon as one leaf of the plan has the default size)
+
+import pyarrow as pa
+from itertools import islice
+from pyspark.sql.pandas.types import to_arrow_schema
+
+def estimate_size(df):
+    plan = df._jdf.queryExecution().optimizedPlan()
+    default = spark._jsparkSession.sessionState().conf().defaultSizeInBytes()
+    leaves = plan.collectLeaves()
+    if any(int(str(leaves.apply(i).stats().sizeInBytes())) >= default for i in range(leaves.size())):
+        return None
+    size = int(str(plan.stats().sizeInBytes()))
+    return None if size >= default else size
+
+def iterate_rows(df, max_partition_bytes=64*1024*1024, prefetch=False):
+    size = estimate_size(df)
+    if size is not None:
+        partitions = df.rdd.getNumPartitions()
+        if size / partitions > max_partition_bytes:
+            needed = -(-size // max_partition_bytes)
+            raise ValueError(f"~{size // partitions} bytes per partition is more than max_partition_bytes={max_partition_bytes}, "
+                             f"lower spark.sql.files.maxPartitionBytes before reading, or use df.repartition({needed}) "
+                             f"(shuffles everything and loses the order)")
+    return df.toLocalIterator(prefetchPartitions=prefetch)
+
+def iterate_batches(df, batch_size=10000, as_arrow=False, **kwargs):
+    schema = to_arrow_schema(df.schema) if as_arrow else None
+    rows = iterate_rows(df, **kwargs)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield pa.RecordBatch.from_pylist([r.asDict(recursive=True) for r in batch], schema=schema) if as_arrow else batch
+
+# COMMAND ----------
+
+for i in iterate_rows(df):
+    print(f"Name is {i.name} and age is {i.age}")
+
+# COMMAND ----------
+
+# only the partitions needed for the first 2 rows are computed (df.take(2) works too when we don't need to loop)
+
+list(islice(iterate_rows(df), 2))
+
+# COMMAND ----------
+
+for batch in iterate_batches(df, batch_size=2, as_arrow=True):
+    print(batch.num_rows, batch.to_pydict())
+
+# COMMAND ----------
+
 df.select()
 
 # COMMAND ----------
@@ -1039,6 +1814,95 @@ ny_city.select("collision_id", "contributing_factor_vehicle_1").show()
 
 # COMMAND ----------
 
+# multiline json can't be split, so the whole file is read and parsed by one task
+# converting the json array into newline delimited json (one record per line) makes it splittable again
+# the file is read in small chunks and only one record is kept in memory at a time
+
+import json, os, re, shutil
+
+def json_array_to_ndjson(src_path, out_dir, records_per_file=100000, chunk_size=1024*1024):
+    decoder = json.JSONDecoder()
+    skip = re.compile(r"[\s,]*")
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir)
+
+    file_no, count, out = 0, 0, None
+    buf, pos, eof, started = "", 0, False, False
+    with open(src_path, "r", encoding="utf-8") as f:
+        while True:
+            pos = skip.match(buf, pos).end()
+            if pos == len(buf) and not eof:
+                buf, pos = f.read(chunk_size), 0
+                eof = buf == ""
+                continue
+            if not started:
+                if buf[pos:pos+1] != "[":
+                    raise ValueError(f"{src_path} is not a json array")
+                started, pos = True, pos + 1
+                continue
+            if buf[pos:pos+1] == "]":
+                break
+            if pos == len(buf):
+                raise ValueError(f"{src_path} ends before the closing ] of the json array")
+            try:
+                record, end = decoder.raw_decode(buf, pos)
+                if end == len(buf) and not eof:
+                    raise ValueError("record may continue in the next chunk")
+            except ValueError:
+                if eof:
+                    raise
+                more = f.read(chunk_size)
+                eof = more == ""
+                buf, pos = buf[pos:] + more, 0
+                continue
+            pos = end
+
+            if out is None or count == records_per_file:
+                if out is not None:
+                    out.close()
+                out = open(os.path.join(out_dir, f"part-{file_no:05d}.json"), "w", encoding="utf-8")
+                file_no, count = file_no + 1, 0
+            out.write(json.dumps(record) + "\n")
+            count += 1
+
+    if out is not None:
+        out.close()
+    return file_no
+
+# COMMAND ----------
+
+# /dbfs/ is the local path of dbfs on the driver
+
+json_array_to_ndjson("/dbfs/FileStore/tables/ny_city.json", "/dbfs/FileStore/tables/ny_city_ndjson", records_per_file=500)
+dbutils.fs.ls("/FileStore/tables/ny_city_ndjson")
+
+# COMMAND ----------
+
+# no multiline option needed now, each part file (and each block of a big part file) gets its own task
+
+ny_city_ndjson = spark.read.json("/FileStore/tables/ny_city_ndjson")
+display(ny_city_ndjson)
+
+# COMMAND ----------
+
+# comparing multiline read vs conversion + ndjson read
+# the conversion runs on the driver, so for a file read only once it has to be counted too,
+# a file read again and again pays for it once and then only the ndjson read
+
+import time
+
+start = time.time()
+spark.read.option("multiline", "true").json("/FileStore/tables/ny_city.json").write.format("noop").mode("overwrite").save()
+print(f"multiline json : {time.time() - start:.2f} sec")
+
+start = time.time()
+json_array_to_ndjson("/dbfs/FileStore/tables/ny_city.json", "/dbfs/FileStore/tables/ny_city_ndjson", records_per_file=500)
+converted = time.time()
+spark.read.json("/FileStore/tables/ny_city_ndjson").write.format("noop").mode("overwrite").save()
+print(f"conversion + ndjson : {time.time() - start:.2f} sec (conversion {converted - start:.2f} sec, read {time.time() - converted:.2f} sec)")
+
+# COMMAND ----------
+
 df.write.mode("overwrite").save("/FileStore/tables/ny_city_sink")
 
 # COMMAND ----------
@@ -1190,6 +2054,162 @@ mapped_df.collect()
 
 # COMMAND ----------
 
+# rdd.map() sends every row to python and back, and the optimizer can't see inside the lambda
+# simple functions like update_age() only pick columns and use + - * / on numbers, the same works on Column objects
+# so we call the function once with a fake row whose x.age / x[2] stand for the columns, and get back the column expressions
+# the fake row can't see `x.age is None`, isinstance() or a branch taken on anything else, so only straight line functions
+# are tried : the bytecode may only load values, use + - * / and build the result, no branch (if / else, and / or),
+# no comparison or `is`, no call (isinstance(), str(), other functions, methods), no f-string
+# the stand-ins then only allow what gives the same result as python : + - * / on numeric columns and numbers
+# (None in + - * / fails like the TypeError in python, whole numbers are computed as decimal(38,0) and fail
+# instead of overflowing, / is always a float and fails on 0)
+# anything else raises and the function falls back to rdd.map(), so a lambda calling update_age() uses rdd.map() too
+
+import dis
+from pyspark.sql import Column
+from pyspark.sql.functions import col, lit, raise_error, when
+from pyspark.sql.types import DoubleType, FloatType, IntegralType
+
+_straight_line_ops = {"RESUME", "NOP", "CACHE", "COPY_FREE_VARS", "LOAD_FAST", "LOAD_FAST_CHECK", "LOAD_FAST_LOAD_FAST", "LOAD_DEREF",
+                      "LOAD_GLOBAL", "LOAD_CONST", "LOAD_ATTR", "STORE_FAST", "STORE_FAST_LOAD_FAST", "STORE_FAST_STORE_FAST",
+                      "BINARY_OP", "BINARY_ADD", "BINARY_SUBTRACT", "BINARY_MULTIPLY", "BINARY_TRUE_DIVIDE", "UNARY_NEGATIVE",
+                      "BINARY_SUBSCR", "BUILD_TUPLE", "BUILD_LIST", "LIST_EXTEND", "UNPACK_SEQUENCE", "SWAP", "ROT_TWO",
+                      "RETURN_VALUE", "RETURN_CONST"}
+
+def _check_straight_line(func):
+    code = getattr(func, "__code__", None)
+    if code is None:
+        raise TypeError(f"{func!r} is not a python function")
+    ops = {i.opname for i in dis.get_instructions(code)} - _straight_line_ops
+    if ops:
+        raise TypeError(f"Function uses {sorted(ops)}, only straight line functions can be compiled")
+
+def _number_kind(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return "int"
+    if isinstance(value, float):
+        return "float"
+    return None
+
+class _ValueColumn:
+    def __init__(self, column, kind=None, computed=False):
+        self.column, self.kind, self.computed = column, kind, computed
+
+    @staticmethod
+    def _wrap(value):
+        if isinstance(value, _ValueColumn):
+            return value
+        if _number_kind(value) is None:
+            raise TypeError(f"Can't use {type(value).__name__} with a column")
+        return _ValueColumn(lit(value), _number_kind(value))
+
+    def _arith(self, other, op, reverse=False):
+        a, b = (self._wrap(other), self) if reverse else (self, self._wrap(other))
+        if a.kind is None or b.kind is None:
+            raise TypeError(f"Can't use {op} on non numeric columns")
+        checked = when(a.column.isNull() | b.column.isNull(), raise_error(lit(f"unsupported operand None for {op}")))
+        if op == "/":
+            divisor = b.column.cast("double")
+            return _ValueColumn(checked.when(divisor == 0, raise_error(lit("division by zero"))).otherwise(a.column.cast("double") / divisor), "float", True)
+        kind = "int" if a.kind == b.kind == "int" else "float"
+        cast = "decimal(38,0)" if kind == "int" else "double"
+        x, y = a.column.cast(cast), b.column.cast(cast)
+        return _ValueColumn(checked.otherwise({"+": x + y, "-": x - y, "*": x * y}[op]), kind, True)
+
+    def __add__(self, other): return self._arith(other, "+")
+    def __radd__(self, other): return self._arith(other, "+", True)
+    def __sub__(self, other): return self._arith(other, "-")
+    def __rsub__(self, other): return self._arith(other, "-", True)
+    def __mul__(self, other): return self._arith(other, "*")
+    def __rmul__(self, other): return self._arith(other, "*", True)
+    def __truediv__(self, other): return self._arith(other, "/")
+    def __rtruediv__(self, other): return self._arith(other, "/", True)
+
+    def __neg__(self):
+        return self._arith(-1, "*")
+
+    def _unsupported(self, *args):
+        raise TypeError("Not supported on a column")
+
+    __str__ = __format__ = __bool__ = __iter__ = __len__ = _unsupported
+    __mod__ = __rmod__ = __floordiv__ = __rfloordiv__ = __pow__ = __rpow__ = _unsupported
+    __eq__ = __ne__ = __lt__ = __le__ = __gt__ = __ge__ = _unsupported
+    __hash__ = None
+
+class _RowColumns:
+    def __init__(self, schema):
+        self._fields = {f.name: f.dataType for f in schema.fields}
+        self._columns = [f.name for f in schema.fields]
+
+    def _value(self, name):
+        data_type = self._fields[name]
+        kind = "int" if isinstance(data_type, IntegralType) else "float" if isinstance(data_type, (FloatType, DoubleType)) else None
+        return _ValueColumn(col(name), kind)
+
+    def __getattr__(self, name):
+        if name.startswith("_") or name not in self._fields:
+            raise AttributeError(name)
+        return self._value(name)
+
+    def __getitem__(self, key):
+        return self._value(self._columns[key] if isinstance(key, int) else key)
+
+def _result_column(value):
+    if isinstance(value, _ValueColumn):
+        if value.kind == "int" and value.computed:
+            long_range = value.column.between(lit(-2**63), lit(2**63 - 1))
+            return when(long_range, value.column.cast("long")).otherwise(raise_error(lit("integer overflow")))
+        return value.column
+    if isinstance(value, Column):
+        return value
+    if value is None or isinstance(value, (bool, int, float)):
+        return lit(value)
+    raise TypeError(f"Can't return {type(value).__name__} from a column expression")
+
+def compile_row_map(df, func, names=None):
+    _check_straight_line(func)
+    out = func(_RowColumns(df.schema))
+    out = out if isinstance(out, (tuple, list)) else (out,)
+    names = names or df.columns
+    if len(names) != len(out):
+        raise ValueError(f"Function returns {len(out)} values for {len(names)} column names")
+    return df.select([_result_column(c).alias(n) for c, n in zip(out, names)])
+
+def map_rows(df, func, names=None):
+    try:
+        return compile_row_map(df, func, names)
+    except Exception as e:
+        print(f"Could not convert to column expressions, using rdd.map() : {e}")
+        return df.rdd.map(func).toDF(names or df.columns)
+
+# COMMAND ----------
+
+new_df = map_rows(df, update_age)
+new_df.explain()
+new_df.show()
+
+# COMMAND ----------
+
+map_rows(df, lambda x : (x[0], x[1], x[2]+5, x[3]), ["id", "name", "age", "gender"]).show()
+
+# COMMAND ----------
+
+# comparing rdd.map() vs map_rows() on 5 million rows (benchmark() is defined in the vectorized udf section)
+
+from pyspark.sql.functions import concat
+
+big_df = spark.range(5000000).select(col("id").cast("int").alias("id"), concat(lit("name_"), col("id")).alias("name"), (col("id") % 60).cast("int").alias("age"), lit("Male").alias("gender"))
+
+benchmark("rdd.map", big_df.rdd.map(update_age).toDF(["id", "name", "age", "gender"]))
+benchmark("map_rows", map_rows(big_df, update_age))
+
+# both should give the same result
+print(df.rdd.map(update_age).toDF(["id", "name", "age", "gender"]).exceptAll(map_rows(df, update_age)).count() == 0)
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC
 # MAGIC #### cache() & persist()
@@ -1234,6 +2254,160 @@ mapped_df.count()
 
 # COMMAND ----------
 
+# every cell above persists a new mapped_df and the old one stays in the executors memory until unpersist() is called
+# CacheManager keeps the persisted dataframes by name, unpersists the least recently used ones when the memory budget is full
+# and picks the storage level from the estimated size (estimate_size() is defined in the collect() section)
+# size known and fits in the budget -> MEMORY_ONLY, size unknown -> MEMORY_AND_DISK, bigger than the budget -> DISK_ONLY
+
+from collections import OrderedDict
+from pyspark import StorageLevel
+from pyspark.sql import DataFrame
+
+class CacheManager:
+    def __init__(self, memory_budget=1024*1024*1024):
+        self.memory_budget = memory_budget
+        self.entries = OrderedDict()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def memory_used(self):
+        return sum(size or 0 for _, size, level in self.entries.values() if level.useMemory)
+
+    def persist(self, name, df, size=None):
+        self.unpersist(name)
+        if size is None and isinstance(df, DataFrame):
+            size = estimate_size(df)
+
+        if size is None:
+            level = StorageLevel.MEMORY_AND_DISK
+        elif size > self.memory_budget:
+            level = StorageLevel.DISK_ONLY
+        else:
+            level = StorageLevel.MEMORY_ONLY
+            while self.memory_used() + size > self.memory_budget:
+                self.unpersist(next(n for n, (_, _, l) in self.entries.items() if l.useMemory))
+                self.evictions += 1
+
+        self.entries[name] = (df.persist(level), size, level)
+        return df
+
+    def get(self, name):
+        if name not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(name)
+        return self.entries[name][0]
+
+    def get_or_persist(self, name, build):
+        df = self.get(name)
+        return df if df is not None else self.persist(name, build())
+
+    def unpersist(self, name):
+        if name in self.entries:
+            self.entries.pop(name)[0].unpersist()
+
+    def clear(self):
+        for name in list(self.entries):
+            self.unpersist(name)
+
+    def stats(self):
+        return {
+            "entries": {name: {"size": size, "level": str(level)} for name, (_, size, level) in self.entries.items()},
+            "memory_used": self.memory_used(),
+            "memory_budget": self.memory_budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+# COMMAND ----------
+
+mapped_df.unpersist()
+
+cache_manager = CacheManager(memory_budget=512*1024*1024)
+
+# map_rows() is defined in the map transformation section
+mapped = cache_manager.get_or_persist("mapped_df", lambda: map_rows(df, update_age))
+mapped.count()
+
+# COMMAND ----------
+
+# second call is a hit, nothing is built or persisted again
+
+mapped = cache_manager.get_or_persist("mapped_df", lambda: map_rows(df, update_age))
+cache_manager.stats()
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC
+# MAGIC #### Many statistics in one groupBy
+
+# COMMAND ----------
+
+# df9.groupBy("ID", "Name").sum(...), .max(...), .min(...) and .avg(...) read and shuffle the same data four times
+# summarize() puts every statistic of every column in one agg(), so it is one job
+# stats -> sum, min, max, mean, count, stddev and approximate quantiles written as p50, p90, p99.9 ...
+# (all the quantiles of a column are computed by one percentile_approx(), p99.9 of Marks comes out as p99_9_Marks)
+# with cache_name the result is kept in cache_manager (from the cache() & persist() section) and reused,
+# the key is the name plus the dataframe's plan and the arguments, so a call with other columns or stats computes its own result
+
+import re
+from pyspark.sql.functions import avg, col, count, max as max_, min as min_, percentile_approx, stddev, sum as sum_
+
+_stat_functions = {"sum": sum_, "min": min_, "max": max_, "mean": avg, "count": count, "stddev": stddev}
+
+def summarize(df, group_by, columns, stats=("sum", "min", "max", "mean"), accuracy=10000, cache_name=None):
+    group_by = [group_by] if isinstance(group_by, str) else list(group_by)
+    columns = [columns] if isinstance(columns, str) else list(columns)
+    quantiles = [s for s in stats if re.fullmatch(r"p\d+(\.\d+)?", s)]
+    unknown = [s for s in stats if s not in _stat_functions and s not in quantiles]
+    if unknown:
+        raise ValueError(f"Unknown statistics : {unknown}, use {list(_stat_functions)} or quantiles like p50")
+    out_of_range = [q for q in quantiles if float(q[1:]) > 100]
+    if out_of_range:
+        raise ValueError(f"Quantiles must be between p0 and p100 : {out_of_range}")
+
+    def build():
+        aggs = [_stat_functions[s](col(c)).alias(f"{s}_{c}") for c in columns for s in stats if s not in quantiles]
+        if quantiles:
+            aggs += [percentile_approx(col(c), [float(q[1:]) / 100 for q in quantiles], accuracy).alias(f"_q_{c}") for c in columns]
+        result = df.groupBy(*group_by).agg(*aggs)
+        if quantiles:
+            result = result.select(*[c for c in result.columns if not c.startswith("_q_")],
+                                   *[col(f"_q_{c}")[i].alias(f"{q.replace('.', '_')}_{c}") for c in columns for i, q in enumerate(quantiles)])
+        return result
+
+    if not cache_name:
+        return build()
+    key = f"{cache_name}[{df.semanticHash()}|{','.join(group_by)}|{','.join(columns)}|{','.join(stats)}|{accuracy}]"
+    return cache_manager.get_or_persist(key, build)
+
+# COMMAND ----------
+
+summarize(df9, ["ID", "Name"], "Marks").show()
+
+# COMMAND ----------
+
+summarize(df10, "department", ["salary", "bonus"], stats=["sum", "mean", "stddev", "count", "p50", "p90"], cache_name="department_summary").show()
+
+# COMMAND ----------
+
+# four groupBy jobs vs one summarize() on 20 million rows (benchmark() is from the vectorized udf section)
+
+from pyspark.sql.functions import rand
+
+marks_df = spark.range(20000000).select((col("id") % 100000).alias("ID"), (col("id") % 100000).cast("string").alias("Name"), (rand(1) * 100).cast("int").alias("Marks")).cache()
+marks_df.count()
+
+four_jobs = sum(benchmark(name, getattr(marks_df.groupBy("ID", "Name"), name)("Marks")) for name in ["sum", "max", "min", "avg"])
+print(f"four groupBy jobs : {four_jobs:.2f} sec")
+benchmark("summarize", summarize(marks_df, ["ID", "Name"], "Marks"))
+
+marks_df.unpersist()
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC
 # MAGIC #### Connect to blob storage using SAS token
@@ -1335,6 +2509,132 @@ display(data)
 
 # COMMAND ----------
 
+# rest_api() opens a new connection for every call, gives only the first page and fails on the first bad response
+# a session keeps the connections open (pool), Retry retries 429/5xx responses with backoff
+# pages are fetched in parallel using the total count and offset / limit (like pokeapi), else by following the "next" link
+
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+def api_session(max_workers=8, retries=5, backoff=0.5):
+    retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def _page_url(url, offset, limit):
+    parts = urlsplit(url)
+    query = dict(parse_qsl(parts.query))
+    query.update(offset=offset, limit=limit)
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+def fetch_pages(url, page_size=100, max_workers=8, session=None, timeout=30):
+    session = session or api_session(max_workers)
+
+    def get(page_url):
+        response = session.get(page_url, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+    page = get(_page_url(url, 0, page_size))
+    yield page
+
+    if "count" not in page:
+        while page.get("next"):
+            page = get(page["next"])
+            yield page
+        return
+
+    # only a few pages are requested at a time so the driver memory stays bounded
+    offsets = list(range(page_size, page["count"], page_size))
+    window = max_workers * 4
+    with ThreadPoolExecutor(max_workers) as pool:
+        for i in range(0, len(offsets), window):
+            yield from pool.map(get, [_page_url(url, o, page_size) for o in offsets[i:i+window]])
+
+# COMMAND ----------
+
+# pages are written in batches so the whole response never has to fit on the driver
+
+def api_to_table(url, path, format="delta", mode="append", batch_pages=50, schema=None, **kwargs):
+    rows, pages = [], 0
+    for page in fetch_pages(url, **kwargs):
+        rows.extend(page["results"])
+        pages += 1
+        if pages % batch_pages == 0:
+            save_indexed(spark.createDataFrame(rows, schema).write.format(format).mode(mode), path)
+            rows, mode = [], "append"
+    if rows:
+        save_indexed(spark.createDataFrame(rows, schema).write.format(format).mode(mode), path)
+    return pages
+
+# COMMAND ----------
+
+api_to_table("https://pokeapi.co/api/v2/pokemon", "/FileStore/tables/pokemon", mode="overwrite", schema="name string, url string")
+display(spark.read.format("delta").load("/FileStore/tables/pokemon"))
+
+# COMMAND ----------
+
+# testing against a local stub server : 2000 items, 20 ms latency per request and every 7th request fails once with 503
+
+import json, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class StubApi(BaseHTTPRequestHandler):
+    total, requests_seen, fail_every = 2000, 0, 7
+
+    def do_GET(self):
+        StubApi.requests_seen += 1
+        time.sleep(0.02)
+        if StubApi.fail_every and StubApi.requests_seen % StubApi.fail_every == 0:
+            self.send_response(503)
+            self.end_headers()
+            return
+        query = dict(parse_qsl(urlsplit(self.path).query))
+        offset, limit = int(query.get("offset", 0)), int(query.get("limit", 20))
+        end = min(offset + limit, StubApi.total)
+        next_url = f"http://localhost:{self.server.server_port}/items?offset={end}&limit={limit}" if end < StubApi.total else None
+        body = json.dumps({"count": StubApi.total, "next": next_url, "results": [{"name": f"item-{i}", "url": f"/items/{i}"} for i in range(offset, end)]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+stub = ThreadingHTTPServer(("localhost", 0), StubApi)
+threading.Thread(target=stub.serve_forever, daemon=True).start()
+stub_url = f"http://localhost:{stub.server_port}/items"
+
+# COMMAND ----------
+
+# rest_api() following the next link one page at a time vs fetch_pages()
+# rest_api() has no retries, so the failures are turned off for it
+
+StubApi.fail_every = 0
+start, pages, page = time.time(), 0, rest_api(f"{stub_url}?offset=0&limit=20")
+while page:
+    pages += 1
+    page = rest_api(page["next"]) if page["next"] else None
+print(f"rest_api : {pages} pages, {pages / (time.time() - start):.1f} pages/sec")
+
+StubApi.fail_every = 7
+start = time.time()
+results = [r for p in fetch_pages(stub_url, page_size=20) for r in p["results"]]
+print(f"fetch_pages : {len(results) // 20} pages, {len(results) // 20 / (time.time() - start):.1f} pages/sec")
+print(len(results) == StubApi.total and len(set(r["name"] for r in results)) == StubApi.total)
+
+stub.shutdown()
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC
 # MAGIC #### Creating dynamic schema
@@ -1369,6 +2669,105 @@ print(final_schema)
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC
+# MAGIC #### Schema registry
+
+# COMMAND ----------
+
+# inferSchema reads the whole file one extra time only to find the datatypes
+# and json inference keeps every value of ny_city as string (the counts and crash_date are quoted in the file)
+# so we keep the typed schema of every dataset in one place and pass it while reading
+
+from pyspark.sql.types import StructType, StructField, StringType, IntegerType, LongType, DoubleType, TimestampType
+
+schema_registry = {}
+
+def validate_schema(schema):
+    if not isinstance(schema, StructType):
+        raise TypeError(f"Expected StructType, got {type(schema).__name__}")
+    names = [f.name.lower() for f in schema.fields]
+    duplicates = sorted(set(n for n in names if names.count(n) > 1))
+    if "" in names or duplicates:
+        raise ValueError(f"Invalid column names in schema : {duplicates or ['']}")
+    for f in schema.fields:
+        if isinstance(f.dataType, StructType):
+            validate_schema(f.dataType)
+
+def register_schema(dataset, schema):
+    validate_schema(schema)
+    schema_registry[dataset] = schema
+
+register_schema("airlines", StructType([
+    StructField("Name", StringType(), True),
+    StructField("IATA", StringType(), True),
+    StructField("ICAO", StringType(), True),
+    StructField("Callsign", StringType(), True),
+    StructField("Country", StringType(), True),
+    StructField("Active", StringType(), True)
+]))
+
+register_schema("flights", StructType([
+    StructField("year", IntegerType(), True),
+    StructField("month", StringType(), True),
+    StructField("passengers", IntegerType(), True)
+]))
+
+register_schema("ny_city", StructType(
+    [StructField("crash_date", TimestampType(), True), StructField("crash_time", StringType(), True)]
+    + [StructField(c, StringType(), True) for c in ["on_street_name", "off_street_name", "cross_street_name", "borough", "zip_code"]]
+    + [StructField(f"number_of_{p}_{s}", IntegerType(), True) for p in ["persons", "pedestrians", "cyclist", "motorist"] for s in ["injured", "killed"]]
+    + [StructField(f"contributing_factor_vehicle_{i}", StringType(), True) for i in range(1, 6)]
+    + [StructField(c, StringType(), True) for c in ["vehicle_type_code1", "vehicle_type_code2", "vehicle_type_code_3", "vehicle_type_code_4", "vehicle_type_code_5"]]
+    + [StructField("collision_id", LongType(), True), StructField("latitude", DoubleType(), True), StructField("longitude", DoubleType(), True)]
+    + [StructField("location", StructType([
+        StructField("latitude", DoubleType(), True),
+        StructField("longitude", DoubleType(), True),
+        StructField("human_address", StringType(), True)
+    ]), True)]
+))
+
+# COMMAND ----------
+
+# json reader doesn't convert quoted numbers ("2") to int, so json is read with the same columns as string and then casted
+# for csv, enforceSchema=false makes spark check the header against the schema instead of silently using it
+
+from pyspark.sql.functions import col
+
+def _string_schema(schema):
+    return StructType([StructField(f.name, _string_schema(f.dataType) if isinstance(f.dataType, StructType) else StringType(), True) for f in schema.fields])
+
+def read_dataset(dataset, path, format="csv", **options):
+    reader = spark.read.format(format).options(**options)
+    schema = schema_registry.get(dataset)
+    if schema is None:
+        print(f"No schema registered for {dataset}, inferring schema")
+        return reader.option("inferSchema", "true").load(path)
+    if format == "json":
+        return reader.schema(_string_schema(schema)).load(path).select([col(f.name).cast(f.dataType) for f in schema.fields])
+    return reader.schema(schema).option("enforceSchema", "false").load(path)
+
+# COMMAND ----------
+
+ny_city_typed = read_dataset("ny_city", "/FileStore/tables/ny_city.json", format="json", multiline="true")
+ny_city_typed.printSchema()
+display(ny_city_typed)
+
+# COMMAND ----------
+
+# all the count columns of ny_city in one pass with the NullImputer from the handling null values section
+
+count_columns = [c for c in ny_city_typed.columns if c.startswith("number_of_")]
+ny_city_imputer = NullImputer({**{c: "median" for c in count_columns}, "borough": "mode", "latitude": "mean", "longitude": "mean"})
+display(ny_city_imputer.fit_transform(ny_city_typed))
+
+# COMMAND ----------
+
+flights = read_dataset("flights", "/FileStore/tables/flights.csv", header="true")
+flights.printSchema()
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC
 # MAGIC #### Dynamic delimiter for csv data
@@ -1392,6 +2791,62 @@ get_delimiter("/FileStore/tables/flights1.csv")
 
 # COMMAND ----------
 
+# get_delimiter() starts a spark job only to read one line and takes the first , ; or | it finds (even inside quotes)
+# sniff_delimiter() reads only the first few KB of the file on the driver and parses them with every candidate
+# the delimiter which gives the same number (> 1) of columns on most of the lines wins, quoted values are handled by the csv module
+# results are cached per path and only sniffed again when the size or modification time of the file changes
+
+import csv, io, os
+from concurrent.futures import ThreadPoolExecutor
+
+_delimiter_cache = {}
+
+def _local_path(path):
+    if path.startswith("dbfs:"):
+        path = path[len("dbfs:"):]
+    return path if path.startswith("/dbfs/") or os.path.exists(path) else "/dbfs" + path
+
+def sniff_delimiter(path, candidates=",;|\t", sample_bytes=64*1024, max_lines=50):
+    path = _local_path(path)
+    stat = os.stat(path)
+    cached = _delimiter_cache.get(path)
+    if cached and cached[:2] == (stat.st_mtime, stat.st_size):
+        return cached[2]
+
+    with open(path, "r", encoding="utf-8", errors="replace", newline="") as f:
+        sample = f.read(sample_bytes)
+    if len(sample) == sample_bytes and "\n" in sample:
+        sample = sample[:sample.rindex("\n")]
+
+    best, best_score = None, (0, 0)
+    for d in candidates:
+        rows = [len(r) for _, r in zip(range(max_lines), csv.reader(io.StringIO(sample), delimiter=d)) if r]
+        if not rows:
+            continue
+        columns = max(set(rows), key=rows.count)
+        score = (rows.count(columns) / len(rows), columns)
+        if columns > 1 and score > best_score:
+            best, best_score = d, score
+
+    _delimiter_cache[path] = (stat.st_mtime, stat.st_size, best)
+    return best
+
+def sniff_directory(path, max_workers=16):
+    path = _local_path(path)
+    files = [e.path for e in os.scandir(path) if e.is_file() and not e.name.startswith(("_", "."))]
+    with ThreadPoolExecutor(max_workers) as pool:
+        return dict(zip(files, pool.map(sniff_delimiter, files)))
+
+# COMMAND ----------
+
+sniff_delimiter("/FileStore/tables/flights1.csv")
+
+# COMMAND ----------
+
+sniff_directory("/FileStore/tables/")
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC
 # MAGIC #### Creating table with dynamic schema
@@ -1408,7 +2863,7 @@ def delta_table(tablename, schema):
     try:
         spark.sql(f"""CREATE TABLE IF NOT EXISTS testing.{tablename} ({schema}) USING DELTA LOCATION '/FIleStore/tables/delta/{tablename}' """)
         print(f"Table created ; {tablename}")
-    except expection as e:
+    except Exception as e:
         print(f"Error occured: {e}")
 
 # COMMAND ----------
@@ -1439,7 +2894,7 @@ def main():
         df = spark.read.json("/FileStore/tables/ddl_schema.json")
         for i in df.collect():
             delta_table(i.tablename, i.schema)
-    except expection as e:
+    except Exception as e:
         print(f"Error occured: {e}")
 
 main()
@@ -1464,6 +2919,42 @@ main()
 
 # COMMAND ----------
 
+# main() sends one CREATE TABLE IF NOT EXISTS at a time, even for the tables which are already there
+# create_tables() lists the tables of the database once, skips the existing ones and creates the rest in parallel
+# it returns the status and time taken for every table
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+def create_tables(ddl, database="testing", max_workers=8):
+    # catalog.listTables() describes every table one by one, SHOW TABLES only lists the names
+    existing = {r.tableName.lower() for r in spark.sql(f"SHOW TABLES IN {database}").collect() if not r.isTemporary}
+    report = {d["tablename"]: ("exists", 0.0) for d in ddl if d["tablename"].lower() in existing}
+
+    def create(d):
+        start = time.time()
+        try:
+            spark.sql(f"""CREATE TABLE IF NOT EXISTS {database}.{d["tablename"]} ({d["schema"]}) USING DELTA LOCATION '/FIleStore/tables/delta/{d["tablename"]}' """)
+            status = "created"
+        except Exception as e:
+            status = f"failed : {e}"
+        return d["tablename"], status, time.time() - start
+
+    with ThreadPoolExecutor(max_workers) as pool:
+        for tablename, status, seconds in pool.map(create, [d for d in ddl if d["tablename"] not in report]):
+            report[tablename] = (status, seconds)
+
+    for tablename, (status, seconds) in report.items():
+        print(f"{tablename} : {status} ({seconds:.2f} sec)")
+    return report
+
+# COMMAND ----------
+
+ddl = [r.asDict() for r in spark.read.json("/FileStore/tables/ddl_schema.json").collect()]
+report = create_tables(ddl)
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC
 # MAGIC #### Creating demo data using farsante
@@ -1552,6 +3043,153 @@ len(dbutils.fs.ls("/FileStore/tables/table2"))
 
 # COMMAND ----------
 
+# maxRecordsPerFile=50 or repartition(3) gives very different file sizes for a wide table (ny_city) and a narrow one (airlines)
+# plan_write() writes a small sample in the output format to find the bytes per row on disk,
+# and from that the number of files and rows per file so every file is close to target_bytes
+# with partition_by, every output partition gets its own number of files (big partitions are spread over more tasks)
+
+import math, uuid
+from functools import reduce
+from pyspark.sql.functions import broadcast, ceil, col, lit, rand
+
+def bytes_per_row(df, format="parquet", sample_rows=10000, **options):
+    sample = df.limit(sample_rows).cache()
+    rows = sample.count()
+    if rows == 0:
+        sample.unpersist()
+        return 0
+    tmp = f"/tmp/write_planner/{uuid.uuid4().hex}"
+    sample.write.format(format).options(**options).save(tmp)
+    size = sum(f.size for f in _data_files(tmp))
+    dbutils.fs.rm(tmp, True)
+    sample.unpersist()
+    return size / rows
+
+def plan_write(df, format="parquet", target_bytes=128*1024*1024, partition_by=None, rows=None, **options):
+    row_bytes = bytes_per_row(df, format, **options) or 1
+    rows = df.count() if rows is None else rows
+    records_per_file = max(1, int(target_bytes // row_bytes))
+    files = max(1, math.ceil(rows * row_bytes / target_bytes))
+    print(f"{rows} rows, {row_bytes:.1f} bytes per row -> ~{files} files of {records_per_file} rows")
+
+    if not partition_by:
+        return df.repartition(files), records_per_file
+
+    # number of files for every partition value, rows of a value are spread randomly over its files
+    keys = [f"_key{i}" for i in range(len(partition_by))]
+    counts = df.groupBy(*partition_by).count() \
+        .select(*[col(p).alias(k) for p, k in zip(partition_by, keys)], ceil(col("count") * row_bytes / target_bytes).alias("_files"))
+    condition = reduce(lambda a, b: a & b, [df[p].eqNullSafe(col(k)) for p, k in zip(partition_by, keys)])
+    planned = df.join(broadcast(counts), condition) \
+        .withColumn("_file", (rand() * col("_files")).cast("int")) \
+        .repartition(files + counts.count(), *partition_by, "_file") \
+        .drop("_files", "_file", *keys)
+    return planned, records_per_file
+
+def write_planned(df, path, format="parquet", mode="overwrite", target_bytes=128*1024*1024, partition_by=None, **options):
+    planned, records_per_file = plan_write(df, format, target_bytes, partition_by, **options)
+    writer = planned.write.format(format).mode(mode).options(**options).option("maxRecordsPerFile", records_per_file)
+    if partition_by:
+        writer = writer.partitionBy(*partition_by)
+    save_indexed(writer, path)
+
+# COMMAND ----------
+
+write_planned(df, "/FileStore/tables/table3", format="delta")
+dbutils.fs.ls("/FileStore/tables/table3")
+
+# COMMAND ----------
+
+write_planned(ny_city, "/FileStore/tables/ny_city_planned", format="parquet", target_bytes=32*1024*1024, partition_by=["borough"])
+dbutils.fs.ls("/FileStore/tables/ny_city_planned")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC
+# MAGIC #### Choosing format and compression per dataset
+
+# COMMAND ----------
+
+# employees.csv is plain csv, ny_city goes to json and the rest to parquet / delta, every writer picked by hand
+# a write policy per dataset (same names as the schema registry) says the format and the compression codec,
+# write_dataset() looks it up and writes with write_planned(), read_written() reads it back with the registered schema
+# compression -> snappy (fast, default for parquet / delta), zstd (smaller files for about the same read time), gzip
+# csv / json only support gzip of these, and a gzip file can not be split, so one task reads the whole file
+
+default_write_policy = {"format": "parquet", "compression": "snappy"}
+write_policies = {}
+
+def register_write_policy(dataset, format="parquet", compression="snappy", partition_by=None, **options):
+    if format in ("csv", "json") and compression not in (None, "none", "gzip"):
+        raise ValueError(f"{format} can not be written with {compression}, use gzip or none")
+    write_policies[dataset] = {"format": format, "compression": compression or "none", "partition_by": partition_by, **options}
+
+def write_policy(dataset, **overrides):
+    return {**default_write_policy, **write_policies.get(dataset, {}), **overrides}
+
+def write_dataset(df, dataset, path, mode="overwrite", **overrides):
+    policy = write_policy(dataset, **overrides)
+    format, partition_by = policy.pop("format"), policy.pop("partition_by", None)
+    write_planned(df, path, format=format, mode=mode, partition_by=partition_by, **policy)
+
+def read_written(dataset, path):
+    policy = write_policy(dataset)
+    options = {k: v for k, v in policy.items() if k not in ("format", "compression", "partition_by")}
+    if policy["format"] in ("parquet", "delta"):
+        return spark.read.format(policy["format"]).load(path)
+    return read_dataset(dataset, path, format=policy["format"], **options)
+
+register_write_policy("employees", format="parquet", compression="zstd")
+register_write_policy("ny_city", format="parquet", compression="zstd", partition_by=["borough"])
+register_write_policy("airlines", format="delta", compression="snappy")
+
+# COMMAND ----------
+
+write_dataset(df10, "employees", "dbfs:/user/hive/warehouse/employees")
+read_written("employees", "dbfs:/user/hive/warehouse/employees").show()
+
+# COMMAND ----------
+
+# write time, bytes on disk and time to read everything back for every format / codec (benchmark() is from the vectorized udf section)
+# the datasets are scaled up by repeating them, copy by copy, so the values repeat like they do in real data and not row after row
+
+import time
+from pyspark.sql.types import ArrayType, MapType, StructType
+
+format_codecs = [("csv", "none"), ("csv", "gzip"), ("json", "gzip"), ("parquet", "snappy"), ("parquet", "zstd"), ("parquet", "gzip"), ("delta", "snappy"), ("delta", "zstd")]
+
+def benchmark_formats(df, name, copies=1, combinations=format_codecs, root="/tmp/format_benchmark"):
+    # the copy number gets its own name, the datasets can have an id column of their own
+    df = spark.range(copies).toDF("_copy").crossJoin(df).drop("_copy").cache()
+    rows = df.count()
+    nested = any(isinstance(f.dataType, (ArrayType, MapType, StructType)) for f in df.schema.fields)
+    results = []
+    for format, compression in combinations:
+        if format == "csv" and nested:
+            continue  # csv can not hold struct / array / map columns (ny_city's location)
+        path = f"{root}/{name}/{format}_{compression}"
+        start = time.time()
+        save_indexed(df.write.format(format).mode("overwrite").option("compression", compression).option("header", "true"), path)
+        write_seconds = time.time() - start
+        reader = spark.read.format(format).option("header", "true")
+        read_seconds = benchmark(f"{name} {format} {compression}", reader.load(path) if format in ("parquet", "delta") else reader.schema(df.schema).load(path))
+        size = sum(f.size for f in fs_index.walk(path))
+        results.append((name, rows, format, compression, round(write_seconds, 2), size, round(read_seconds, 2)))
+        dbutils.fs.rm(path, True)
+        fs_index.invalidate(path)
+    df.unpersist()
+    return spark.createDataFrame(results, "dataset string, rows long, format string, compression string, write_sec double, bytes long, read_sec double")
+
+# COMMAND ----------
+
+format_results = benchmark_formats(df10, "employees", copies=200000) \
+    .union(benchmark_formats(spark.table("airlines"), "airlines", copies=200)) \
+    .union(benchmark_formats(ny_city_typed, "ny_city", copies=50))
+display(format_results.orderBy("dataset", "bytes"))
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC
 # MAGIC #### Delta Table
@@ -1766,6 +3404,98 @@ df.createOrReplaceTempView("temp_person");
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC
+# MAGIC #### Upserts with merge
+
+# COMMAND ----------
+
+# "on t1.id = t2.id" alone makes delta look at every file of the target
+# upsert() adds conditions which delta can use to skip files :
+#   - every key must be between the min and max of that key in the source (checked against the min / max stats of the files)
+#   - partition columns must be one of the partition values present in the source (records are matched inside their partition)
+# the source is deduplicated on the keys first (latest order_col wins), because merge fails if two source rows match one target row
+# files scanned / rewritten come from the operationMetrics of the merge in the table history
+
+from functools import reduce
+from delta.tables import DeltaTable
+from pyspark.sql.functions import col, lit, row_number, min as min_, max as max_
+from pyspark.sql.window import Window
+
+def _delta_table(target):
+    return DeltaTable.forPath(spark, target) if "/" in target else DeltaTable.forName(spark, target)
+
+def upsert(target, source, keys, partition_cols=None, order_col=None):
+    keys, partition_cols = list(keys), list(partition_cols or [])
+    if order_col:
+        latest = Window.partitionBy(*keys).orderBy(col(order_col).desc())
+        source = source.withColumn("_rn", row_number().over(latest)).filter(col("_rn") == 1).drop("_rn")
+    else:
+        source = source.dropDuplicates(keys)
+    source = source.cache()
+
+    conditions = [col(f"t.{k}") == col(f"s.{k}") for k in keys] + [col(f"t.{p}").eqNullSafe(col(f"s.{p}")) for p in partition_cols]
+    bounds = source.agg(*[f(k).alias(f"{name}_{k}") for k in keys for f, name in [(min_, "min"), (max_, "max")]]).first()
+    if bounds is None or bounds[0] is None:
+        source.unpersist()
+        print("upsert : source is empty")
+        return None
+    conditions += [col(f"t.{k}").between(lit(bounds[f"min_{k}"]), lit(bounds[f"max_{k}"])) for k in keys]
+    for p in partition_cols:
+        values = [r[0] for r in source.select(p).distinct().collect()]
+        in_values = col(f"t.{p}").isin([v for v in values if v is not None])
+        conditions.append(in_values | col(f"t.{p}").isNull() if None in values else in_values)
+
+    table = _delta_table(target)
+    table.alias("t").merge(source.alias("s"), reduce(lambda a, b: a & b, conditions)) \
+        .whenMatchedUpdateAll().whenNotMatchedInsertAll().execute()
+    source.unpersist()
+
+    metrics = table.history(1).select("operationMetrics").first()[0]
+    report = {m: int(metrics[m]) for m in ["numTargetFilesBeforeSkipping", "numTargetFilesAfterSkipping", "numTargetFilesRemoved",
+                                           "numTargetFilesAdded", "numTargetRowsUpdated", "numTargetRowsInserted", "numTargetRowsCopied"] if m in metrics}
+    print(f"upsert : {report}")
+    return report
+
+# COMMAND ----------
+
+# many small upserts are collected and merged in one go, every merge rewrites files so one merge per hour is cheaper than one per batch
+# rows of a later batch win over the same key in an earlier batch
+
+class UpsertBatcher:
+    def __init__(self, target, keys, max_batches=20, **upsert_options):
+        self.target, self.keys, self.max_batches, self.upsert_options = target, keys, max_batches, upsert_options
+        self.pending = []
+
+    def add(self, df):
+        self.pending.append(df.withColumn("_batch", lit(len(self.pending))))
+        if len(self.pending) >= self.max_batches:
+            return self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return None
+        source = reduce(lambda a, b: a.unionByName(b), self.pending)
+        self.pending = []
+        latest = Window.partitionBy(*self.keys).orderBy(col("_batch").desc())
+        source = source.withColumn("_rn", row_number().over(latest)).filter(col("_rn") == 1).drop("_rn", "_batch")
+        return upsert(self.target, source, self.keys, **self.upsert_options)
+
+# COMMAND ----------
+
+upsert("delta_table", spark.table("delta_table2"), ["id"])
+display(spark.table("delta_table"))
+
+# COMMAND ----------
+
+batcher = UpsertBatcher("delta_table", ["id"])
+batcher.add(spark.createDataFrame([(9, "Rahul"), (10, "Anita")], "id int, name string"))
+batcher.add(spark.createDataFrame([(10, "Anita K"), (11, "Mohan")], "id int, name string"))
+batcher.flush()
+display(spark.table("delta_table"))
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC
 # MAGIC #### Check if file is empty or not
@@ -1776,9 +3506,16 @@ display(df)
 
 # COMMAND ----------
 
+# count() scans the complete dataframe, head(1) stops as soon as it finds one row
+
+def is_empty(df):
+    return len(df.head(1)) == 0
+
+# COMMAND ----------
+
 def check_df_size(df):
     try:
-        if df.count() == 0:
+        if is_empty(df):
             print("df is empty")
         else:
             print(f"Length of dataframe is {df.count()}")
@@ -1793,6 +3530,89 @@ len(df.collect())
 
 # COMMAND ----------
 
+# row count without reading the data
+# delta -> every file added in the _delta_log has its numRecords in the stats, so we replay the log (last checkpoint + newer json commits)
+# parquet -> the row count of every file is in its footer (hidden _temporary / _compaction-* / .* directories are not
+# read by spark either), a directory with a _delta_log is a delta table and its removed files are still there,
+# so it is counted through delta
+# if the stats are missing or the log can't be read the count falls back to df.count()
+
+import json, os, re
+import pyarrow.parquet as pq
+from concurrent.futures import ThreadPoolExecutor
+
+def delta_row_count(path):
+    log_dir = os.path.join(_local_path(path), "_delta_log")
+    names = os.listdir(log_dir)
+    checkpoints = [n for n in names if re.fullmatch(r"\d{20}\.checkpoint(\.\d+\.\d+)?\.parquet", n)]
+    checkpoint_version = max((int(n[:20]) for n in checkpoints), default=-1)
+
+    files = {}
+    def add(action):
+        deleted = (action.get("deletionVector") or {}).get("cardinality", 0)
+        files[action["path"]] = (action.get("stats"), deleted)
+
+    for n in checkpoints:
+        if int(n[:20]) == checkpoint_version:
+            for action in pq.read_table(os.path.join(log_dir, n), columns=["add"]).column("add").to_pylist():
+                if action:
+                    add(action)
+    for n in sorted(n for n in names if re.fullmatch(r"\d{20}\.json", n) and int(n[:20]) > checkpoint_version):
+        with open(os.path.join(log_dir, n)) as f:
+            for line in f:
+                action = json.loads(line)
+                if "add" in action:
+                    add(action["add"])
+                elif "remove" in action:
+                    files.pop(action["remove"]["path"], None)
+
+    total = 0
+    for stats, deleted in files.values():
+        if not stats or "numRecords" not in json.loads(stats):
+            return None
+        total += json.loads(stats)["numRecords"] - deleted
+    return total
+
+def parquet_row_count(path, max_workers=16):
+    if os.path.isdir(os.path.join(_local_path(path), "_delta_log")):
+        return None
+    files = []
+    for root, dirs, names in os.walk(_local_path(path)):
+        dirs[:] = [d for d in dirs if not d.startswith(("_", "."))]
+        files += [os.path.join(root, n) for n in names if n.endswith(".parquet") and not n.startswith(("_", "."))]
+    with ThreadPoolExecutor(max_workers) as pool:
+        return sum(pool.map(lambda f: pq.read_metadata(f).num_rows, files))
+
+def row_count(df=None, path=None, format=None):
+    if path and format == "delta":
+        try:
+            count = delta_row_count(path)
+        except Exception as e:
+            print(f"Could not read the delta log, counting the rows : {e}")
+            count = None
+        if count is not None:
+            return count
+    if path and format == "parquet":
+        count = parquet_row_count(path)
+        if count is not None:
+            return count
+        format = "delta"
+    if df is None:
+        df = spark.read.format(format).load(path)
+    return df.count()
+
+# COMMAND ----------
+
+# table1 is written in the "Having limited rows saved in partfile" section
+
+row_count(path="/FileStore/tables/table1", format="delta")
+
+# COMMAND ----------
+
+row_count(path="/FileStore/tables/airlines1", format="parquet")
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC
 # MAGIC #### input_file_name()
@@ -1812,6 +3632,338 @@ display(df1)
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC
+# MAGIC #### Reading only the files which can match a filter
+
+# COMMAND ----------
+
+# instead of copying the name of a part file, we give the root directory and a filter like [("Active", "=", "Y"), ("Country", "=", "Russia")]
+# the manifest of the directory (every parquet file, its partition values from the path, and min / max of every column
+# from the parquet footer) is built once and cached
+# files whose partition value or min / max can't match the filter are not read at all, the filter is still applied on the
+# remaining files, so the result is the same as filtering the full directory
+
+import os
+from urllib.parse import unquote
+import pyarrow.parquet as pq
+from pyspark.sql.functions import col, lit
+
+_manifest_cache = {}
+
+def _spark_path(local_path):
+    return "dbfs:" + local_path[len("/dbfs"):] if local_path.startswith("/dbfs/") else local_path
+
+def _file_stats(path):
+    metadata = pq.read_metadata(path)
+    stats = {}
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        for j in range(row_group.num_columns):
+            column = row_group.column(j)
+            s = column.statistics
+            name = column.path_in_schema
+            if s is None or not s.has_min_max or (name in stats and stats[name] is None):
+                stats[name] = None
+            elif name in stats:
+                stats[name] = (min(stats[name][0], s.min), max(stats[name][1], s.max))
+            else:
+                stats[name] = (s.min, s.max)
+    return stats
+
+def file_manifest(root, refresh=False):
+    root = _local_path(root).rstrip("/")
+    if refresh or root not in _manifest_cache:
+        manifest = []
+        for directory, subdirs, names in os.walk(root):
+            subdirs[:] = [d for d in subdirs if not d.startswith(("_", "."))]
+            parts = [p.split("=", 1) for p in os.path.relpath(directory, root).split(os.sep) if "=" in p]
+            partitions = {k: None if v == "__HIVE_DEFAULT_PARTITION__" else unquote(v) for k, v in parts}
+            for name in names:
+                if name.endswith(".parquet") and not name.startswith(("_", ".")):
+                    path = os.path.join(directory, name)
+                    manifest.append({"path": path, "size": os.path.getsize(path), "partitions": partitions, "stats": _file_stats(path)})
+        _manifest_cache[root] = manifest
+    return _manifest_cache[root]
+
+# writes through our own writers (see FsIndex) drop the cached manifest too
+
+def _drop_manifests(path):
+    for root in list(_manifest_cache):
+        key = fs_index._key(_spark_path(root))
+        if key == path or key.startswith(path + "/") or path.startswith(key + "/"):
+            del _manifest_cache[root]
+
+fs_index.callbacks.append(_drop_manifests)
+
+def _can_match(low, high, op, value):
+    if op == "=":
+        return low <= value <= high
+    if op == "!=":
+        return not (low == high == value)
+    if op == "<":
+        return low < value
+    if op == "<=":
+        return low <= value
+    if op == ">":
+        return high > value
+    if op == ">=":
+        return high >= value
+    if op == "in":
+        return any(low <= v <= high for v in value)
+    raise ValueError(f"Unsupported operator : {op}")
+
+# partition values are strings in the path, only the exact conversions are compared (bool("false") is True),
+# any other value raises and the file is kept
+
+def _partition_value(part, sample):
+    if isinstance(sample, bool):
+        return {"true": True, "false": False}[part.lower()]
+    if isinstance(sample, (int, float)) and "_" not in part:
+        return type(sample)(part)
+    if isinstance(sample, str):
+        return part
+    raise TypeError(f"Can't compare partition value {part} with {sample!r}")
+
+def _file_can_match(file, filters):
+    for column, op, value in filters:
+        try:
+            if column in file["partitions"]:
+                part = file["partitions"][column]
+                if part is None:
+                    return False
+                part = _partition_value(part, value[0] if op == "in" else value)
+                if not _can_match(part, part, op, value):
+                    return False
+            elif file["stats"].get(column) is not None and not _can_match(*file["stats"][column], op, value):
+                return False
+        except (TypeError, ValueError, KeyError, IndexError):
+            pass
+    return True
+
+def _filter_column(column, op, value):
+    c = col(column)
+    return {"=": c == value, "!=": c != value, "<": c < value, "<=": c <= value, ">": c > value, ">=": c >= value}[op] if op != "in" else c.isin(value)
+
+def read_pruned(root, filters, refresh=False):
+    manifest = file_manifest(root, refresh)
+    files = [f for f in manifest if _file_can_match(f, filters)]
+    print(f"Reading {len(files)} of {len(manifest)} files, {sum(f['size'] for f in files)} of {sum(f['size'] for f in manifest)} bytes")
+
+    condition = lit(True)
+    for column, op, value in filters:
+        condition = condition & _filter_column(column, op, value)
+    if not files:
+        return spark.read.parquet(root).where(lit(False))
+    return spark.read.option("basePath", _spark_path(_local_path(root).rstrip("/"))).parquet(*[_spark_path(f["path"]) for f in files]).where(condition)
+
+# COMMAND ----------
+
+df = read_pruned("/FileStore/tables/airlines1", [("Active", "=", "Y"), ("Country", "=", "Russia")])
+display(df)
+
+# COMMAND ----------
+
+# same result as the full scan
+
+full = spark.read.parquet("/FileStore/tables/airlines1").where((col("Active") == "Y") & (col("Country") == "Russia"))
+print(full.exceptAll(df).count() == 0 and df.exceptAll(full).count() == 0)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC
+# MAGIC #### Data skipping index
+
+# COMMAND ----------
+
+# min / max only skips a file when the rows are clustered, with Country spread over every file each file has min "Afghanistan" and max "Zimbabwe"
+# write_clustered() writes the files sorted by range of the cluster_by columns (or by their z-order, so each of
+# several columns stays roughly clustered) and build_skip_index() writes a _skip_index.json sidecar in the root with,
+# for every file, its partition values, min / max and a bloom filter of the chosen columns
+# the bloom filters are built on the executors (one group per file) from the values as strings
+# a bloom filter skips a file for "=" / "in" even if the values are not clustered (a name is in one file only)
+# bloom filters are kept for string columns only and used only for str values, spark's text of other types
+# (true, 5.0) is not python's str() (True, 5), other columns are skipped by min / max
+# read_skipping() reads only the files the sidecar can't rule out, the root is listed fresh on every call (not through
+# fs_index, most writers here don't invalidate it), so files written after the index or rewritten since are always read
+# strings are z-ordered by a hash bucket, so equal values are clustered but ranges of strings are not
+
+import base64, json, math
+import numpy as np
+import pandas as pd
+from functools import reduce
+from urllib.parse import unquote, urlparse
+from pyspark.sql.functions import col, filter as filter_, input_file_name, lit, pmod, shiftleft, shiftright, size, xxhash64
+from pyspark.sql.types import NumericType, StringType
+
+_skip_index_cache = {}
+
+# the values are hashed by pandas, the bit positions come from _key_bloom_positions() (removing duplicates across appends section)
+
+def _value_bloom_positions(values, m, k):
+    h = pd.util.hash_pandas_object(pd.Series(list(values), dtype=object).astype(str), index=False).to_numpy(np.uint64)
+    return _key_bloom_positions(h.view(np.int64), m, k)
+
+def _bloom(values, fpp=0.01):
+    n = max(1, len(values))
+    m = max(64, math.ceil(-n * math.log(fpp) / math.log(2) ** 2))
+    k = max(1, round(m / n * math.log(2)))
+    bits = np.zeros(m, dtype=bool)
+    if len(values):
+        bits[_value_bloom_positions(values, m, k).ravel()] = True
+    return {"bits": base64.b64encode(np.packbits(bits).tobytes()).decode(), "m": m, "k": k}
+
+def _bloom_might_contain(bloom, values):
+    bits = np.unpackbits(np.frombuffer(base64.b64decode(bloom["bits"]), dtype=np.uint8))
+    return bool(bits[_value_bloom_positions(values, bloom["m"], bloom["k"])].all(axis=1).any())
+
+def _zorder_value(df, columns, bits=8):
+    if bits * len(columns) > 62:
+        raise ValueError(f"Can not z-order {len(columns)} columns with {bits} bits each, use fewer columns or bits")
+    buckets = 2 ** bits
+    ranks = []
+    for c in columns:
+        if isinstance(df.schema[c].dataType, NumericType):
+            bounds = sorted(set(df.approxQuantile(c, [i / buckets for i in range(1, buckets)], 0.01)))
+            ranks.append(size(filter_(lit(bounds), lambda b: b < col(c))).cast("long"))
+        else:
+            ranks.append(pmod(xxhash64(col(c)), lit(buckets)))
+    return reduce(lambda z, bit: z.bitwiseOR(shiftleft(shiftright(ranks[bit[1]], bit[0]).bitwiseAND(lit(1)), bit[0] * len(ranks) + bit[1])),
+                  [(b, i) for b in range(bits) for i in range(len(ranks))], lit(0).cast("long"))
+
+def write_clustered(df, path, cluster_by, zorder=False, files=None, target_bytes=128*1024*1024, mode="overwrite", index_columns=None, **options):
+    cluster_by = [cluster_by] if isinstance(cluster_by, str) else list(cluster_by)
+    files = files or max(1, math.ceil(df.count() * bytes_per_row(df, "parquet", **options) / target_bytes))
+    order = cluster_by
+    if zorder and len(cluster_by) > 1:
+        df, order = df.withColumn("_zorder", _zorder_value(df, cluster_by)), ["_zorder"]
+    clustered = df.repartitionByRange(files, *order).sortWithinPartitions(*order).drop("_zorder")
+    save_indexed(clustered.write.format("parquet").mode(mode).options(**options), path)
+    if index_columns:
+        return build_skip_index(path, index_columns)
+
+def build_skip_index(root, columns, fpp=0.01):
+    local_root = _local_path(root).rstrip("/")
+    manifest = file_manifest(root, refresh=True)
+    partition_cols = {k for f in manifest for k in f["partitions"]}
+    data = spark.read.parquet(_spark_path(local_root))
+    bloom_cols = [c for c in columns if c not in partition_cols and isinstance(data.schema[c].dataType, StringType)]
+
+    def file_blooms(pdf):
+        return pd.DataFrame([(pdf["_file"].iloc[0], c, json.dumps(_bloom(pdf[c].dropna().unique(), fpp))) for c in bloom_cols],
+                            columns=["file", "column", "bloom"])
+
+    blooms = {}
+    if bloom_cols:
+        values = data.select(input_file_name().alias("_file"), *bloom_cols)
+        for r in values.groupBy("_file").applyInPandas(file_blooms, "file string, column string, bloom string").collect():
+            file = os.path.relpath(_local_path(unquote(urlparse(r.file).path)), local_root)
+            blooms.setdefault(file, {})[r.column] = json.loads(r.bloom)
+
+    index = {"columns": list(columns), "fpp": fpp, "files": {}}
+    for f in manifest:
+        file = os.path.relpath(f["path"], local_root)
+        index["files"][file] = {"size": f["size"], "partitions": f["partitions"],
+                                "stats": {c: f["stats"].get(c) for c in columns if c not in partition_cols}, "blooms": blooms.get(file, {})}
+    with open(f"{local_root}/_skip_index.json", "w") as out:
+        json.dump(index, out, default=str)
+    fs_index.invalidate(_spark_path(local_root))
+    print(f"Indexed {len(manifest)} files on {list(columns)}")
+    return index
+
+def _load_skip_index(root):
+    key = fs_index._key(root)
+    if key not in _skip_index_cache:
+        try:
+            with open(f"{_local_path(root).rstrip('/')}/_skip_index.json") as f:
+                _skip_index_cache[key] = json.load(f)
+        except FileNotFoundError:
+            _skip_index_cache[key] = None
+    return _skip_index_cache[key]
+
+def _drop_skip_indexes(path):
+    for key in list(_skip_index_cache):
+        if key == path or key.startswith(path + "/") or path.startswith(key + "/"):
+            del _skip_index_cache[key]
+
+fs_index.callbacks.append(_drop_skip_indexes)
+
+def _indexed_file_can_match(entry, filters):
+    if not _file_can_match(entry, filters):
+        return False
+    for column, op, value in filters:
+        bloom = entry["blooms"].get(column)
+        values = list(value) if op == "in" else [value]
+        if bloom is None or op not in ("=", "in") or not all(isinstance(v, str) for v in values):
+            continue
+        if not _bloom_might_contain(bloom, values):
+            return False
+    return True
+
+def skip_report(root, filters):
+    index = _load_skip_index(root) or {"files": {}}
+    local_root = _local_path(root).rstrip("/")
+    files = []
+    for directory, subdirs, names in os.walk(local_root):
+        subdirs[:] = [d for d in subdirs if not d.startswith(("_", "."))]
+        files += [os.path.join(directory, n) for n in names if n.endswith(".parquet") and not n.startswith(("_", "."))]
+    read = []
+    for path in files:
+        entry = index["files"].get(os.path.relpath(path, local_root))
+        if entry is None or entry["size"] != os.path.getsize(path) or _indexed_file_can_match(entry, filters):
+            read.append(path)
+    report = {"files": len(files), "read": len(read), "skipped": len(files) - len(read),
+              "skipped_fraction": round(1 - len(read) / len(files), 3) if files else 0.0, "paths": [_spark_path(p) for p in read]}
+    print(f"{filters} : skipped {report['skipped']} of {report['files']} files ({report['skipped_fraction']:.1%})")
+    return report
+
+def read_skipping(root, filters):
+    report = skip_report(root, filters)
+    condition = reduce(lambda a, b: a & b, [_filter_column(*f) for f in filters], lit(True))
+    if not report["paths"]:
+        return spark.read.parquet(root).where(lit(False))
+    return spark.read.option("basePath", _spark_path(_local_path(root).rstrip("/"))).parquet(*report["paths"]).where(condition)
+
+# COMMAND ----------
+
+airlines_df = spark.table("airlines")
+
+write_clustered(airlines_df, "/FileStore/tables/airlines_clustered", "Country", files=20, index_columns=["Country", "Name"])
+write_clustered(airlines_df, "/FileStore/tables/airlines_zorder", ["Country", "Active"], zorder=True, files=20, index_columns=["Country", "Name"])
+save_indexed(airlines_df.repartition(20).write.format("parquet").mode("overwrite"), "/FileStore/tables/airlines_unclustered")
+build_skip_index("/FileStore/tables/airlines_unclustered", ["Country", "Name"])
+
+# COMMAND ----------
+
+# fraction of files skipped for a few selective filters, on every layout
+
+skip_filters = [[("Country", "=", "Russia")], [("Name", "=", "135 Airways")], [("Country", "in", ["India", "Nepal"])], [("Country", "=", "Russia"), ("Active", "=", "Y")]]
+for root in ["/FileStore/tables/airlines_unclustered", "/FileStore/tables/airlines_clustered", "/FileStore/tables/airlines_zorder"]:
+    print(root)
+    for filters in skip_filters:
+        skip_report(root, filters)
+
+# COMMAND ----------
+
+df = read_skipping("/FileStore/tables/airlines_clustered", [("Country", "=", "Russia")])
+print(df.count() == airlines_df.where(col("Country") == "Russia").count())
+
+# COMMAND ----------
+
+# same check on non string columns (skipped by min / max only)
+
+from pyspark.sql.functions import length
+
+airlines_typed = airlines_df.withColumn("is_active", col("Active") == "Y").withColumn("name_length", length("Name").cast("double"))
+write_clustered(airlines_typed, "/FileStore/tables/airlines_typed", "name_length", files=20, index_columns=["is_active", "name_length"])
+
+for filters, condition in [([("is_active", "=", True)], col("is_active")), ([("name_length", "=", 5)], col("name_length") == 5)]:
+    df = read_skipping("/FileStore/tables/airlines_typed", filters)
+    print(df.count() == airlines_typed.where(condition).count())
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC
 # MAGIC #### Validate table using Delta Lake
@@ -1840,6 +3992,64 @@ display(delta_table.history().select("operationMetrics.numOutputRows").where(col
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC
+# MAGIC #### Incremental pipeline with structured streaming
+
+# COMMAND ----------
+
+# the first cell of this notebook only displays a stream, nothing is written and nothing remembers what was already read
+# run_pipeline() reads only the new data of the source table and appends it to the sink, the checkpoint keeps the progress,
+# so the next run continues where the last one stopped
+# trigger="availableNow" -> processes everything new (in several micro batches) and stops, good for scheduled jobs
+# trigger="10 seconds" (any interval) -> keeps running and starts a micro batch every interval
+# max_files_per_trigger / max_bytes_per_trigger -> size of one micro batch
+
+def run_pipeline(source_path, sink_path, checkpoint_path, source_format="delta", sink_format="delta", trigger="availableNow",
+                 max_files_per_trigger=None, max_bytes_per_trigger=None, transform=None, query_name=None):
+    reader = spark.readStream.format(source_format)
+    if source_format != "delta":
+        reader = reader.schema(spark.read.format(source_format).load(source_path).schema)
+    if max_files_per_trigger:
+        reader = reader.option("maxFilesPerTrigger", max_files_per_trigger)
+    if max_bytes_per_trigger:
+        reader = reader.option("maxBytesPerTrigger", max_bytes_per_trigger)
+
+    df = reader.load(source_path)
+    if transform:
+        df = transform(df)
+
+    writer = df.writeStream.format(sink_format).outputMode("append").option("checkpointLocation", checkpoint_path)
+    if query_name:
+        writer = writer.queryName(query_name)
+    writer = writer.trigger(availableNow=True) if trigger == "availableNow" else writer.trigger(processingTime=trigger)
+    return writer.start(sink_path)
+
+def pipeline_metrics(query):
+    return [
+        {
+            "batch": p["batchId"],
+            "rows": p["numInputRows"],
+            "latency_ms": p["durationMs"].get("triggerExecution"),
+            "rows_per_sec": p.get("processedRowsPerSecond"),
+        }
+        for p in query.recentProgress
+    ]
+
+# COMMAND ----------
+
+query = run_pipeline("/FileStore/tables/airlines", "/FileStore/tables/airlines_stream_sink", "/FileStore/tables/_checkpoints/airlines_stream_sink", max_files_per_trigger=1)
+query.awaitTermination()
+display(pipeline_metrics(query))
+
+# COMMAND ----------
+
+# running it again reads only what was added to the source since the last run
+
+display(spark.read.format("delta").load("/FileStore/tables/airlines_stream_sink"))
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC
 # MAGIC #### Broadcasting 
@@ -1873,6 +4083,143 @@ result_df.show()
 
 
 
+# COMMAND ----------
+
+# smart_join() decides the broadcast itself instead of calling broadcast() by hand
+# the size of each side comes from the optimizer (estimate_size() from the collect() section),
+# and if the optimizer doesn't know it, from a cached 1% sample (spark knows the real size of a cached dataframe)
+# below broadcast_threshold -> broadcast, above max_broadcast_bytes -> never broadcast (merge hint), in between -> spark decides
+# only the side which can be broadcast for the join type is considered (for left joins the right side etc.)
+
+from pyspark.sql.functions import broadcast
+
+def size_of(df, fraction=0.01):
+    size = estimate_size(df)
+    if size is None:
+        sample = df.sample(fraction=fraction, seed=42).cache()
+        if sample.count() == 0:
+            # very small dataframe, a few rows are the whole dataframe
+            sample.unpersist()
+            sample, fraction = df.limit(1000).cache(), 1
+            sample.count()
+        size = int(estimate_size(sample) / fraction)
+        sample.unpersist()
+    return size
+
+def smart_join(left, right, on, how="inner", broadcast_threshold=100*1024*1024, max_broadcast_bytes=None):
+    if max_broadcast_bytes is None:
+        executor_memory = sc._jvm.org.apache.spark.network.util.JavaUtils.byteStringAsBytes(sc.getConf().get("spark.executor.memory", "1g"))
+        max_broadcast_bytes = min(executor_memory // 4, 8*1024*1024*1024)
+
+    sides = {"left": ["right"], "left_outer": ["right"], "leftouter": ["right"], "left_semi": ["right"], "leftsemi": ["right"],
+             "left_anti": ["right"], "leftanti": ["right"], "right": ["left"], "right_outer": ["left"], "rightouter": ["left"],
+             "inner": ["left", "right"], "cross": ["left", "right"]}.get(how.lower(), [])
+    sizes = {"left": size_of(left) if "left" in sides else None, "right": size_of(right) if "right" in sides else None}
+    frames = {"left": left, "right": right}
+
+    candidates = sorted((sizes[s], s) for s in sides)
+    if candidates and candidates[0][0] <= min(broadcast_threshold, max_broadcast_bytes):
+        size, side = candidates[0]
+        frames[side] = broadcast(frames[side])
+        print(f"smart_join : broadcasting {side} side ({size} bytes)")
+    else:
+        for size, side in candidates:
+            if size > max_broadcast_bytes:
+                frames[side] = frames[side].hint("merge")
+                print(f"smart_join : {side} side too big to broadcast ({size} bytes), using sort merge join")
+        if not candidates:
+            print(f"smart_join : {how} join can't be broadcast")
+        elif all(size <= max_broadcast_bytes for size, _ in candidates):
+            print(f"smart_join : sizes {sizes} above broadcast threshold ({min(broadcast_threshold, max_broadcast_bytes)} bytes), leaving it to spark")
+
+    return frames["left"].join(frames["right"], on, how)
+
+# COMMAND ----------
+
+smart_join(large_df, small_df, "Name", "left_outer").show()
+
+# COMMAND ----------
+
+# shuffle join vs broadcast join of a 20 million rows fact table with airlines (benchmark() is from the vectorized udf section)
+# spark's own automatic broadcast is switched off for the shuffle run
+
+from pyspark.sql.functions import col, rand
+
+airlines_dim = spark.table("airlines").select("Name", "Country").dropDuplicates(["Name"])
+names = [r.Name for r in airlines_dim.select("Name").collect()]
+fact = spark.range(20000000).select(col("id").alias("flight_id"), (rand(1) * len(names)).cast("int").alias("airline_no"), (rand(2) * 500).alias("fare"))
+fact = fact.join(broadcast(spark.createDataFrame(list(enumerate(names)), ["airline_no", "Name"])), "airline_no").drop("airline_no").cache()
+fact.count()
+
+auto_threshold = spark.conf.get("spark.sql.autoBroadcastJoinThreshold")
+spark.conf.set("spark.sql.autoBroadcastJoinThreshold", -1)
+benchmark("shuffle join", fact.join(airlines_dim, "Name"))
+benchmark("smart_join", smart_join(fact, airlines_dim, "Name"))
+spark.conf.set("spark.sql.autoBroadcastJoinThreshold", auto_threshold)
+
+fact.unpersist()
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC
+# MAGIC #### Skewed joins
+
+# COMMAND ----------
+
+# joining on state (only NY and CA) sends all the rows of a state to the same shuffle partition, so one or two tasks do all the work
+# skew_join() finds the hot keys from a sample of the left side, gives every row of a hot key a random salt 0..buckets-1
+# and copies the matching right side rows once per salt, so a hot key is spread over buckets tasks
+# other keys get salt 0 and are joined as usual, the salt column is dropped at the end
+# only inner and left joins work this way (the copied right rows would show up several times in right / full joins)
+
+from pyspark.sql.functions import array, col, explode, lit, rand, when
+
+def hot_keys(df, key, fraction=0.01, hot_share=0.05):
+    sample = df.sample(fraction=fraction, seed=42).groupBy(key).count().collect()
+    total = sum(r["count"] for r in sample)
+    return [r[key] for r in sample if r[key] is not None and r["count"] >= hot_share * total]
+
+def skew_join(left, right, key, how="inner", buckets=32, hot=None, **kwargs):
+    if how not in ("inner", "left", "left_outer", "leftouter"):
+        raise ValueError(f"skew_join supports inner and left joins, got {how}")
+    hot = hot_keys(left, key, **kwargs) if hot is None else hot
+    if not hot:
+        print("skew_join : no hot keys, plain join")
+        return left.join(right, key, how)
+    print(f"skew_join : salting {hot} over {buckets} buckets")
+
+    is_hot = col(key).isin(hot)
+    salted_left = left.withColumn("_salt", when(is_hot, (rand() * buckets).cast("int")).otherwise(0))
+    salted_right = right.withColumn("_salt", explode(when(is_hot, array(*[lit(i) for i in range(buckets)])).otherwise(array(lit(0)))))
+    return salted_left.join(salted_right, [key, "_salt"], how).drop("_salt")
+
+# COMMAND ----------
+
+skew_join(emp_df1, emp_df2.select("state", col("employee_name").alias("colleague")), "state", hot=["NY", "CA"], buckets=4).show()
+
+# COMMAND ----------
+
+# plain join vs skew_join on 20 million rows where 2 of 1000 keys have 90% of the rows (benchmark() is from the vectorized udf section)
+# broadcast and spark's own skew handling are switched off so both runs are shuffle joins
+
+states = spark.range(1000).select(when(col("id") == 0, "NY").when(col("id") == 1, "CA").otherwise(col("id").cast("string")).alias("state"))
+dim = states.crossJoin(spark.range(20).withColumnRenamed("id", "office")).cache()
+facts = spark.range(20000000).select(col("id"), when(rand(1) < 0.6, "NY").when(rand(2) < 0.75, "CA").otherwise((rand(3) * 998 + 2).cast("int").cast("string")).alias("state")).cache()
+dim.count(), facts.count()
+
+confs = {c: spark.conf.get(c) for c in ["spark.sql.autoBroadcastJoinThreshold", "spark.sql.adaptive.skewJoin.enabled"]}
+spark.conf.set("spark.sql.autoBroadcastJoinThreshold", -1)
+spark.conf.set("spark.sql.adaptive.skewJoin.enabled", "false")
+plain = benchmark("plain join", facts.join(dim, "state"))
+salted = benchmark("skew_join", skew_join(facts, dim, "state", buckets=64))
+print(f"speedup : {plain / salted:.1f}x")
+for c, v in confs.items():
+    spark.conf.set(c, v)
+
+facts.unpersist()
+dim.unpersist()
+
 # COMMAND ----------
 
 # MAGIC %md